@@ -0,0 +1,308 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+import httpx
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+LOAD_USER_PREFIX = "load"
+# Operation weights of the "mix" scenario, roughly what a browsing client does.
+MIX = {"login": 10, "account": 30, "account_iban": 35, "transfer": 20, "register": 5}
+TOKEN_GROWTH_STAGES = (0, 1000, 10000, 100000)
+# Default REGISTER_BULK_MAX_USERS of the app.
+BULK_REGISTRATION_SIZE = 1000
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    # Nearest-rank percentile.
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(latency for _, latency in samples)
+    statuses = {}
+    for status, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": len(samples),
+        "rps": round(len(samples) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        "statuses": statuses,
+    }
+
+
+class LoadUser:
+    def __init__(self, username, password, iban=None, token=None):
+        self.username = username
+        self.password = password
+        self.iban = iban
+        self.token = token
+
+    @property
+    def headers(self):
+        return {"Authorization": f"Bearer {self.token}"}
+
+
+def registration(username):
+    return {
+        "username": username,
+        "password": f"{username}-pw",
+        "vorname": "Load",
+        "nachname": "Test",
+        "gebdatum": "1990-01-01",
+        "email": f"{username}@loadtest.badbank",
+        "svnummer": "0000000000",
+    }
+
+
+async def setup_users(client, count):
+    # Idempotent: the bulk registration is rejected with 409 when the users
+    # already exist from an earlier run, they are logged in either way.
+    users = [registration(f"{LOAD_USER_PREFIX}{i:05}") for i in range(count)]
+    admin_token = (await client.post("/login", json={"username": "admin", "password": "2148"})).json()["token"]
+    for start in range(0, len(users), BULK_REGISTRATION_SIZE):
+        response = await client.post("/register/bulk", json={"users": users[start:start + BULK_REGISTRATION_SIZE]}, headers={"Authorization": f"Bearer {admin_token}"})
+        if response.status_code not in (200, 409):
+            raise SystemExit(f"setup failed: POST /register/bulk returned {response.status_code}")
+    load_users = []
+    for user in users:
+        load_user = LoadUser(user["username"], user["password"])
+        load_user.token = (await client.post("/login", json={"username": load_user.username, "password": load_user.password})).json()["token"]
+        load_user.iban = (await client.get("/account", headers=load_user.headers)).json()[0]["IBAN"]
+        load_users.append(load_user)
+    return load_users
+
+
+class Scenario:
+    def __init__(self, users, rng):
+        self.users = users
+        self.rng = rng
+        self.registered = 0
+        self.run_id = f"{int(time.time()) % 100000:05}"
+
+    def login(self, client):
+        user = self.rng.choice(self.users)
+        return client.post("/login", json={"username": user.username, "password": user.password})
+
+    def account(self, client):
+        return client.get("/account", headers=self.rng.choice(self.users).headers)
+
+    def account_iban(self, client):
+        return client.get(f"/account/{self.rng.choice(self.users).iban}")
+
+    def transfer(self, client, from_user=None):
+        from_user = from_user or self.rng.choice(self.users)
+        to_user = self.rng.choice(self.users)
+        body = {"from": from_user.iban, "to": to_user.iban, "amount": self.rng.randint(1, 100)}
+        return client.post("/transfer", json=body, headers=from_user.headers)
+
+    def register(self, client):
+        self.registered += 1
+        return client.post("/register", json=registration(f"r{self.run_id}x{self.registered}"))
+
+    def hot_transfer(self, client):
+        # Half of the transfers leave the hot account, half go into it.
+        hot, other = self.users[0], self.rng.choice(self.users[1:])
+        if self.rng.random() < 0.5:
+            return self.transfer(client, from_user=hot)
+        body = {"from": other.iban, "to": hot.iban, "amount": self.rng.randint(1, 100)}
+        return client.post("/transfer", json=body, headers=other.headers)
+
+    def next_request(self, name, client):
+        if name == "mix":
+            operation = self.rng.choices(list(MIX), weights=list(MIX.values()))[0]
+            return operation, getattr(self, operation)(client)
+        if name == "hot-transfer":
+            return "transfer", self.hot_transfer(client)
+        return "account", self.account(client)
+
+
+async def run_load(client, scenario, name, concurrency, duration, max_requests):
+    samples = {}
+    deadline = time.perf_counter() + duration
+    issued = 0
+
+    async def worker():
+        nonlocal issued
+        while time.perf_counter() < deadline and (max_requests is None or issued < max_requests):
+            issued += 1
+            operation, request = scenario.next_request(name, client)
+            started = time.perf_counter()
+            try:
+                status = (await request).status_code
+            except httpx.HTTPError:
+                status = "error"
+            samples.setdefault(operation, []).append((status, time.perf_counter() - started))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    all_samples = [sample for operation_samples in samples.values() for sample in operation_samples]
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "total": summarize(all_samples, elapsed),
+        "operations": {operation: summarize(operation_samples, elapsed) for operation, operation_samples in sorted(samples.items())},
+    }
+
+
+async def run_token_growth(client, scenario, args, token_store):
+    # Fills the token store with unrelated tokens between stages, then measures
+    # authenticated GET /account with the same load each time.
+    from src.tokens import current_unix_minute
+    stages = {}
+    minute = current_unix_minute()
+    added = 0
+    for size in TOKEN_GROWTH_STAGES:
+        while added < size:
+            token_store.add(f"ghost{added}:{minute}")
+            added += 1
+        stages[str(size)] = await run_load(client, scenario, "token-growth", args.concurrency, args.duration, args.requests)
+        print_stage(f"{size} extra tokens", stages[str(size)])
+    return {"stages": stages}
+
+
+def print_stage(title, result):
+    total = result["total"]
+    print(f"{title}: {total['requests']} requests, {total['rps']} req/s, p50 {total['p50_ms']} ms, p95 {total['p95_ms']} ms, p99 {total['p99_ms']} ms")
+    for operation, summary in result["operations"].items():
+        print(f"  {operation:14} {summary['requests']:7} req  {summary['rps']:8} req/s  p50 {summary['p50_ms']:8} ms  p95 {summary['p95_ms']:8} ms  p99 {summary['p99_ms']:8} ms  {summary['statuses']}")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, baseline_path):
+    baseline = json.loads(Path(baseline_path).read_text())
+    print(f"compared to {baseline_path} ({baseline.get('commit')}):")
+    old, new = baseline.get("result", {}), result
+    if "stages" in new:
+        pairs = [(f"stage {size}", old.get("stages", {}).get(size), stage) for size, stage in new["stages"].items()]
+    else:
+        pairs = [("total", old, new)]
+    for title, before, after in pairs:
+        if not before:
+            continue
+        for key in ("rps", "p50_ms", "p95_ms", "p99_ms"):
+            a, b = before["total"][key], after["total"][key]
+            change = f"{(b - a) / a * 100:+.1f}%" if a and b is not None else "n/a"
+            print(f"  {title:14} {key:7} {a} -> {b} ({change})")
+
+
+def start_uvicorn(port, env):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "src.main:app", "--port", str(port), "--log-level", "warning"],
+        env=env,
+    )
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit("uvicorn exited during startup")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/").status_code == 200:
+                return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("uvicorn did not start within 60s")
+
+
+async def run(args):
+    token_store = None
+    process = None
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=httpx.Limits(max_connections=args.concurrency))
+        lifespan = None
+    elif args.uvicorn:
+        process = start_uvicorn(args.port, dict(os.environ))
+        client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=args.timeout, limits=httpx.Limits(max_connections=args.concurrency))
+        lifespan = None
+    else:
+        from src.main import app, token_store
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://loadtest", timeout=args.timeout)
+        lifespan = app.router.lifespan_context(app)
+    try:
+        if lifespan is not None:
+            await lifespan.__aenter__()
+        async with client:
+            users = await setup_users(client, args.users)
+            scenario = Scenario(users, random.Random(args.seed))
+            if args.scenario == "token-growth":
+                return await run_token_growth(client, scenario, args, token_store)
+            result = await run_load(client, scenario, args.scenario, args.concurrency, args.duration, args.requests)
+            print_stage(args.scenario, result)
+            return result
+    finally:
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay request mixes against the API and report throughput and latency percentiles.")
+    parser.add_argument("scenario", choices=("mix", "hot-transfer", "token-growth"))
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", help="benchmark an already running server instead of the app in-process")
+    target.add_argument("--uvicorn", action="store_true", help="start the app under a local uvicorn for the run")
+    parser.add_argument("--port", type=int, default=8765, help="port for --uvicorn")
+    parser.add_argument("--database-url", help="DATABASE_URL for the in-process app or --uvicorn (default: environment)")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10, help="seconds per run (per stage for token-growth)")
+    parser.add_argument("--requests", type=int, help="stop after this many requests instead of --duration")
+    parser.add_argument("--users", type=int, default=50, help="load users to register and log in")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rate-limit", action="store_true", help="keep the per-client rate limits on (all load comes from one IP)")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--output", help="result file (default: benchmarks/results/<scenario>-<commit>-<time>.json)")
+    parser.add_argument("--compare", help="earlier result file to print the difference against")
+    args = parser.parse_args()
+    if args.scenario == "token-growth" and (args.url or args.uvicorn):
+        parser.error("token-growth fills the token store directly and only runs in-process")
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    if not args.rate_limit:
+        os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+    if args.requests is not None:
+        args.duration = float("inf")
+
+    result = asyncio.run(run(args))
+    commit = git_commit()
+    report = {
+        "scenario": args.scenario,
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "target": args.url or ("uvicorn" if args.uvicorn else "in-process"),
+        "database_url": os.environ.get("DATABASE_URL", "").split("@")[-1],
+        "db_mode": os.environ.get("DB_MODE", "sync"),
+        "rate_limit": os.environ.get("RATE_LIMIT_ENABLED", "true"),
+        "settings": {key: getattr(args, key) for key in ("concurrency", "duration", "requests", "users", "seed")},
+        "result": result,
+    }
+    if report["settings"]["duration"] == float("inf"):
+        report["settings"]["duration"] = None
+    output = Path(args.output) if args.output else RESULTS_DIR / f"{args.scenario}-{commit or 'nogit'}-{int(time.time())}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2) + "\n")
+    print(f"results written to {output}")
+    if args.compare:
+        compare(result, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import httpx
+
+# Runs in a fresh interpreter for every sample, so nothing is cached from an
+# earlier run in the same process.
+IN_PROCESS = """
+import asyncio, json, time
+started = time.perf_counter()
+from src.main import app
+imported = time.perf_counter()
+import httpx
+
+async def first_request():
+    async with app.router.lifespan_context(app):
+        ready = time.perf_counter()
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://startup") as client:
+            status = (await client.get("/")).status_code
+        return ready, time.perf_counter(), status
+
+ready, answered, status = asyncio.run(first_request())
+print(json.dumps({"import": imported - started, "startup": ready - imported, "first_request": answered - ready, "status": status}))
+"""
+
+
+def run_in_process(env):
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", IN_PROCESS], env=env, capture_output=True, text=True, check=True).stdout
+    sample = json.loads(output.strip().splitlines()[-1])
+    sample["process"] = time.perf_counter() - started
+    return sample
+
+
+def run_uvicorn(env, port):
+    # From spawning the server to its first answer, as a load balancer sees it.
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "src.main:app", "--port", str(port), "--log-level", "warning"],
+        env=env,
+    )
+    try:
+        while process.poll() is None:
+            try:
+                status = httpx.get(f"http://127.0.0.1:{port}/").status_code
+                return {"process": time.perf_counter() - started, "status": status}
+            except httpx.HTTPError:
+                time.sleep(0.01)
+        raise SystemExit("uvicorn exited during startup")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import time and time to first request of the app.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--uvicorn", action="store_true", help="start a local uvicorn and time its first answer instead of running in-process")
+    parser.add_argument("--port", type=int, default=8766, help="port for --uvicorn")
+    parser.add_argument("--database-url", help="DATABASE_URL for the app (default: environment)")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    if args.database_url:
+        env["DATABASE_URL"] = args.database_url
+    samples = [run_uvicorn(env, args.port) if args.uvicorn else run_in_process(env) for _ in range(args.runs)]
+    keys = ["process"] if args.uvicorn else ["import", "startup", "first_request", "process"]
+    print(f"{'':14} {'median':>9} {'min':>9} {'max':>9}")
+    for key in keys:
+        values = [sample[key] for sample in samples]
+        print(f"{key:14} {statistics.median(values) * 1000:7.0f}ms {min(values) * 1000:7.0f}ms {max(values) * 1000:7.0f}ms")
+    statuses = {sample["status"] for sample in samples}
+    if statuses != {200}:
+        raise SystemExit(f"unexpected status of the first request: {sorted(statuses)}")
+
+
+if __name__ == "__main__":
+    main()
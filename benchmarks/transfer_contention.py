@@ -0,0 +1,103 @@
+import argparse
+import random
+import threading
+import time
+from sqlalchemy import func
+from src import aggregates, models
+from src.database import SessionLocal, engine
+from src.transfers import TransferError, execute_transfer, wrap_int32
+
+HOT_IBAN = "ATHOT000"
+
+
+def setup_accounts(count, balance):
+    models.Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        db.query(models.Account).filter(models.Account.iban.like("ATHOT%")).delete(synchronize_session=False)
+        db.add_all([models.Account(iban=f"ATHOT{i:03}", kontostand=balance) for i in range(count)])
+        db.commit()
+    finally:
+        db.close()
+    # The rows were replaced behind the balance stats' back.
+    aggregates.reconcile(engine)
+    return [f"ATHOT{i:03}" for i in range(count)]
+
+
+def total_balance():
+    db = SessionLocal()
+    try:
+        return db.query(func.sum(models.Account.kontostand)).filter(models.Account.iban.like("ATHOT%")).scalar()
+    finally:
+        db.close()
+
+
+def legacy_transfer(db, from_iban, to_iban, amount):
+    # The pre-engine implementation: two SELECTs and an ORM read-modify-write.
+    from_account = db.query(models.Account).filter(models.Account.iban == from_iban).first()
+    to_account = db.query(models.Account).filter(models.Account.iban == to_iban).first()
+    to_account.kontostand = wrap_int32(to_account.kontostand + amount)
+    from_account.kontostand = wrap_int32(from_account.kontostand - amount)
+    db.commit()
+
+
+def worker(ibans, transfers, use_legacy, errors, seed):
+    rng = random.Random(seed)
+    db = SessionLocal()
+    try:
+        for _ in range(transfers):
+            other = rng.choice(ibans[1:])
+            from_iban, to_iban = (HOT_IBAN, other) if rng.random() < 0.5 else (other, HOT_IBAN)
+            try:
+                if use_legacy:
+                    legacy_transfer(db, from_iban, to_iban, rng.randint(1, 100))
+                else:
+                    execute_transfer(db, from_iban, to_iban, rng.randint(1, 100))
+            except TransferError:
+                errors.append(1)
+            except Exception:
+                db.rollback()
+                errors.append(1)
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hammer one hot account with concurrent transfers and check that money is conserved.")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--transfers", type=int, default=200, help="transfers per thread")
+    parser.add_argument("--accounts", type=int, default=20)
+    parser.add_argument("--legacy", action="store_true", help="use the old read-modify-write transfer for comparison")
+    args = parser.parse_args()
+
+    ibans = setup_accounts(args.accounts, 10000)
+    expected = total_balance()
+    errors = []
+    threads = [
+        threading.Thread(target=worker, args=(ibans, args.transfers, args.legacy, errors, seed))
+        for seed in range(args.threads)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    actual = total_balance()
+    if args.legacy:
+        # The old transfer does not update the balance stats.
+        aggregates.reconcile(engine)
+
+    done = args.threads * args.transfers - len(errors)
+    print(f"engine:      {'legacy' if args.legacy else 'atomic'} ({engine.dialect.name})")
+    print(f"transfers:   {done} ok, {len(errors)} failed")
+    print(f"elapsed:     {elapsed:.2f}s ({done / elapsed:.0f} transfers/s)")
+    print(f"balance sum: expected {expected}, actual {actual}")
+    if actual != expected:
+        print("FAIL: balance sum not conserved")
+        raise SystemExit(1)
+    print("OK: balance sum conserved")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+from bisect import bisect_right
+from sqlalchemy import BigInteger, cast, func, literal_column, select, text, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError
+from . import models
+
+# Upper bounds of the kontostand buckets. Bucket 0 holds the negative balances
+# that the 32-bit wraparound produces.
+BALANCE_BUCKETS = (0, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+AGGREGATE_STRIPES = int(os.environ.get("AGGREGATE_STRIPES", "16"))
+AGGREGATE_RECONCILE_SECONDS = float(os.environ.get("AGGREGATE_RECONCILE_SECONDS", "3600"))
+REPORT_MAX_ACCOUNTS = 100
+# Postgres advisory lock of the worker that reconciles the stats.
+RECONCILE_LOCK_KEY = 4712
+
+BALANCE_INDEX = text("CREATE INDEX IF NOT EXISTS ix_accounts_kontostand ON accounts (kontostand)")
+
+
+def bucket(balance):
+    return bisect_right(BALANCE_BUCKETS, balance)
+
+
+def bucket_sql(column):
+    # Same buckets as bucket(), for use inside SQL statements.
+    return "CASE " + " ".join(f"WHEN {column} < {edge} THEN {index}" for index, edge in enumerate(BALANCE_BUCKETS)) + f" ELSE {len(BALANCE_BUCKETS)} END"
+
+
+def bucket_label(index):
+    if index == 0:
+        return "<0"
+    if index == len(BALANCE_BUCKETS):
+        return f">={BALANCE_BUCKETS[-1]}"
+    return f"{BALANCE_BUCKETS[index - 1]}-{BALANCE_BUCKETS[index] - 1}"
+
+
+def stripe():
+    return random.randrange(AGGREGATE_STRIPES)
+
+
+def postgres_stats_upsert(changes):
+    # changes is a SELECT of (bucket, accounts, total) rows, for use as one
+    # more CTE of the statement that changes the balances.
+    return (
+        "INSERT INTO balance_stats (stripe, bucket, accounts, total)"
+        f" SELECT :stripe, bucket, SUM(accounts), SUM(total) FROM ({changes}) AS changes GROUP BY bucket"
+        " ON CONFLICT (stripe, bucket) DO UPDATE"
+        " SET accounts = balance_stats.accounts + EXCLUDED.accounts, total = balance_stats.total + EXCLUDED.total"
+    )
+
+
+# Postgres transfers: from the balances before (locked) and after (moved).
+POSTGRES_STATS_UPSERT = postgres_stats_upsert(
+    f"SELECT {bucket_sql('old_kontostand')} AS bucket, -1 AS accounts, -CAST(old_kontostand AS BIGINT) AS total FROM moved"
+    f" UNION ALL SELECT {bucket_sql('kontostand')}, 1, CAST(kontostand AS BIGINT) FROM moved"
+)
+# Postgres seeding: the new accounts (inserted).
+POSTGRES_NEW_ACCOUNTS_STATS_UPSERT = postgres_stats_upsert(
+    f"SELECT {bucket_sql('kontostand')} AS bucket, 1 AS accounts, CAST(kontostand AS BIGINT) AS total FROM inserted"
+)
+
+
+def dialect_name(db):
+    return db.dialect.name if isinstance(db, Connection) else db.get_bind().dialect.name
+
+
+def record(db, changes):
+    # changes are (balance before or None for a new account, balance after).
+    # Runs in the caller's transaction, so the stats commit with the balances.
+    deltas = {}
+    for old, new in changes:
+        if old is not None:
+            delta = deltas.setdefault(bucket(old), [0, 0])
+            delta[0] -= 1
+            delta[1] -= old
+        delta = deltas.setdefault(bucket(new), [0, 0])
+        delta[0] += 1
+        delta[1] += new
+    # All rows go to one stripe, so a transaction never waits for two of them.
+    add(db, stripe(), deltas)
+
+
+def add(db, stripe_index, deltas):
+    # deltas are {bucket: (accounts, total)}, added to the rows of one stripe.
+    rows = [{"stripe": stripe_index, "bucket": index, "accounts": count, "total": total} for index, (count, total) in deltas.items() if count or total]
+    if not rows:
+        return
+    upsert = (postgresql.insert if dialect_name(db) == "postgresql" else sqlite.insert)(models.BalanceStats).values(rows)
+    db.execute(upsert.on_conflict_do_update(
+        index_elements=["stripe", "bucket"],
+        set_={"accounts": models.BalanceStats.accounts + upsert.excluded.accounts, "total": models.BalanceStats.total + upsert.excluded.total},
+    ))
+
+
+def bucket_stats(db):
+    rows = db.execute(
+        select(models.BalanceStats.bucket, func.sum(models.BalanceStats.accounts), func.sum(models.BalanceStats.total))
+        .group_by(models.BalanceStats.bucket)
+    ).all()
+    return {row[0]: (int(row[1]), int(row[2])) for row in rows}
+
+
+def extremes(db, limit):
+    query = select(models.Account.iban, models.Account.kontostand).where(models.Account.kontostand.is_not(None))
+    top = db.execute(query.order_by(models.Account.kontostand.desc()).limit(limit)).all()
+    bottom = db.execute(query.order_by(models.Account.kontostand).limit(limit)).all()
+    return [(row.iban, row.kontostand) for row in top], [(row.iban, row.kontostand) for row in bottom]
+
+
+def collect(db, limit):
+    # Reads a fixed number of stats rows plus 2 * limit index entries,
+    # independent of the number of accounts.
+    return (bucket_stats(db), *extremes(db, limit))
+
+
+def report(parts, limit):
+    # parts are collect() results, one per database (several with shards).
+    distribution = [{"bucket": bucket_label(index), "accounts": 0, "total": 0} for index in range(len(BALANCE_BUCKETS) + 1)]
+    for stats, _, _ in parts:
+        for index, (count, total) in stats.items():
+            distribution[index]["accounts"] += count
+            distribution[index]["total"] += total
+    top = heapq.nlargest(limit, (row for _, rows, _ in parts for row in rows), key=lambda row: row[1])
+    bottom = heapq.nsmallest(limit, (row for _, _, rows in parts for row in rows), key=lambda row: row[1])
+    return {
+        "accounts": sum(entry["accounts"] for entry in distribution),
+        "total": sum(entry["total"] for entry in distribution),
+        "negative_accounts": distribution[0]["accounts"],
+        "distribution": distribution,
+        "top": [{"IBAN": iban, "kontostand": kontostand} for iban, kontostand in top],
+        "bottom": [{"IBAN": iban, "kontostand": kontostand} for iban, kontostand in bottom],
+        "reconciled": dict(last_reconcile),
+    }
+
+
+last_reconcile = {"at": None, "drift": None}
+
+
+# The stats and a full scan of the accounts, both per bucket. One statement,
+# so both are read from the same snapshot.
+RECONCILE_BUCKET = literal_column(bucket_sql("accounts.kontostand"))
+RECONCILE_QUERY = union_all(
+    select(literal_column("0").label("scanned"), models.BalanceStats.bucket.label("bucket"), func.sum(models.BalanceStats.accounts).label("accounts"), func.sum(models.BalanceStats.total).label("total"))
+    .group_by(models.BalanceStats.bucket),
+    select(literal_column("1"), RECONCILE_BUCKET, func.count(), func.sum(cast(models.Account.kontostand, BigInteger)))
+    .where(models.Account.kontostand.is_not(None))
+    .group_by(RECONCILE_BUCKET),
+)
+# pysqlite only opens a transaction on the first write, this no-op write takes
+# the write lock before the scan.
+STATS_WRITE_LOCK = text("UPDATE balance_stats SET accounts = accounts WHERE 1 = 0")
+
+
+def reconcile(bind):
+    # Adds the difference between the scan and the stats to stripe 0. Transfers
+    # that commit meanwhile add their own change on top, so no table lock is
+    # needed. Two runs at once would add the difference twice: on Postgres only
+    # one worker reconciles (see Reconciler), on SQLite the write lock is taken
+    # first.
+    with bind.begin() as conn:
+        if conn.dialect.name != "postgresql":
+            conn.execute(STATS_WRITE_LOCK)
+        before, actual = {}, {}
+        for row in conn.execute(RECONCILE_QUERY):
+            (actual if row.scanned else before)[row.bucket] = (int(row.accounts), int(row.total))
+        diff = {}
+        for index in before.keys() | actual.keys():
+            count, total = actual.get(index, (0, 0))
+            stored_count, stored_total = before.get(index, (0, 0))
+            if (count, total) != (stored_count, stored_total):
+                diff[index] = (count - stored_count, total - stored_total)
+        add(conn, 0, diff)
+    # Without any stats rows the table is new, that is the first build and not drift.
+    drift = bool(before) and bool(diff)
+    if drift:
+        logging.warning(f"Balance stats were off and have been reconciled: {before} -> {actual}")
+    return drift
+
+
+class Reconciler:
+    def __init__(self, interval=AGGREGATE_RECONCILE_SECONDS):
+        self.interval = interval
+        self.binds = []
+        self._locks = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def leads(self, bind):
+        # Every worker starts a reconciler. On Postgres only the one holding
+        # the advisory lock scans, it keeps the lock on a connection of its own
+        # until it stops, and another worker takes over if that one dies.
+        if bind.dialect.name != "postgresql":
+            return True
+        conn = self._locks.get(bind)
+        if conn is not None:
+            try:
+                conn.execute(text("SELECT 1"))
+                return True
+            except DBAPIError:
+                del self._locks[bind]
+                conn.invalidate()
+                conn.close()
+        conn = bind.connect().execution_options(isolation_level="AUTOCOMMIT")
+        if conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": RECONCILE_LOCK_KEY}).scalar():
+            self._locks[bind] = conn
+            return True
+        conn.close()
+        return False
+
+    def reconcile(self):
+        drift = None
+        for bind in self.binds:
+            if self.leads(bind):
+                drift = reconcile(bind) or bool(drift)
+        if drift is not None:
+            last_reconcile.update(at=int(time.time()), drift=drift)
+
+    def _run(self):
+        # The first run is right after startup, off the startup path, since it
+        # scans all accounts.
+        while True:
+            try:
+                self.reconcile()
+            except Exception:
+                logging.exception("Balance stats reconciliation failed")
+            if self.interval <= 0 or self._stop.wait(self.interval):
+                return
+
+    def start(self, binds):
+        # binds are the engines that hold accounts: the primary, or the shards.
+        self.binds = binds
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="balance-stats-reconcile", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        for conn in self._locks.values():
+            # The connection goes back to the pool, which would keep the lock.
+            try:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": RECONCILE_LOCK_KEY})
+            except DBAPIError:
+                conn.invalidate()
+            conn.close()
+        self._locks.clear()
+
+
+reconciler = Reconciler()
@@ -0,0 +1,166 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+
+ACCOUNT_CACHE_TTL_SECONDS = float(os.environ.get("ACCOUNT_CACHE_TTL_SECONDS", "5"))
+ACCOUNT_CACHE_MAX_SIZE = int(os.environ.get("ACCOUNT_CACHE_MAX_SIZE", "10000"))
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.stale = False
+
+
+class _AsyncFlight:
+    def __init__(self):
+        self.future = asyncio.get_running_loop().create_future()
+        self.stale = False
+
+
+class TTLCache:
+    # LRU cache with a per-entry TTL. get_or_load is single-flight: while one
+    # thread loads a key, other threads asking for the same key wait for its
+    # result instead of issuing their own query. aget_or_load does the same
+    # for coroutines on the event loop.
+    def __init__(self, ttl_seconds, max_size):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._async_inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_fresh(self, key):
+        # Must be called with the lock held. Returns (True, value) on a hit.
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[0]
+            del self._entries[key]
+            self.expirations += 1
+        return False, None
+
+    def get_or_load(self, key, loader):
+        with self._lock:
+            hit, value = self._get_fresh(key)
+            if hit:
+                return value
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = loader()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                if flight.error is None and not flight.stale:
+                    self._store(key, flight.value)
+            flight.done.set()
+        return flight.value
+
+    async def aget_or_load(self, key, loader):
+        # Event loop variant of get_or_load: `loader` returns an awaitable and
+        # concurrent callers await the leader's future instead of blocking.
+        with self._lock:
+            hit, value = self._get_fresh(key)
+            if hit:
+                return value
+            flight = self._async_inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._async_inflight[key] = _AsyncFlight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return await asyncio.shield(flight.future)
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            flight.future.cancel()
+            raise
+        except BaseException as e:
+            flight.future.set_exception(e)
+            # Mark the exception as retrieved for when nobody was waiting.
+            flight.future.exception()
+            raise
+        else:
+            flight.future.set_result(value)
+            with self._lock:
+                if not flight.stale:
+                    self._store(key, value)
+        finally:
+            with self._lock:
+                del self._async_inflight[key]
+        return value
+
+    def _store(self, key, value):
+        if self.ttl_seconds <= 0:
+            return
+        self._entries[key] = (value, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+                for inflight in (self._inflight, self._async_inflight):
+                    flight = inflight.get(key)
+                    if flight is not None:
+                        # The running load may have read the old row; hand its
+                        # result to the waiting callers but do not cache it.
+                        flight.stale = True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for flight in list(self._inflight.values()) + list(self._async_inflight.values()):
+                flight.stale = True
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+account_cache = TTLCache(ACCOUNT_CACHE_TTL_SECONDS, ACCOUNT_CACHE_MAX_SIZE)
@@ -0,0 +1,99 @@
+import os
+from sqlalchemy import insert, select, union
+from . import aggregates, models
+
+INITIAL_BALANCE = 10000
+BULK_INSERT_CHUNK_SIZE = 1000
+# Most users one POST /register/bulk may create.
+REGISTER_BULK_MAX_USERS = int(os.environ.get("REGISTER_BULK_MAX_USERS", "1000"))
+
+
+def make_iban(username, user_id):
+    return f"AT{username[:8].upper()}{str(user_id).zfill(3)}"
+
+
+def account_response(iban, kontostand, owner):
+    return {"IBAN": iban, "kontostand": kontostand, "owner": owner}
+
+
+def get_accounts_for_username(db, username):
+    # One round trip: the outer join returns a single row with iban NULL when
+    # the user exists but has no accounts, and no rows when the user is unknown.
+    rows = db.execute(
+        select(models.Account.iban, models.Account.kontostand, models.User.username)
+        .select_from(models.User)
+        .outerjoin(models.Account, models.Account.owner_id == models.User.id)
+        .where(models.User.username == username)
+        .order_by(models.Account.id)
+    ).all()
+    if not rows:
+        return None
+    return [account_response(row.iban, row.kontostand, row.username) for row in rows if row.iban is not None]
+
+
+def get_account_by_iban(db, iban):
+    row = db.execute(
+        select(models.Account.iban, models.Account.kontostand, models.User.username)
+        .outerjoin(models.User, models.Account.owner_id == models.User.id)
+        .where(models.Account.iban == iban)
+    ).first()
+    if row is None:
+        return None
+    return account_response(row.iban, row.kontostand, row.username)
+
+
+def transaction_response(row):
+    return {
+        "id": row.id,
+        "from": row.from_iban,
+        "to": row.to_iban,
+        "amount": row.amount,
+        "from_balance": row.from_balance,
+        "to_balance": row.to_balance,
+        "timestamp": row.created_at,
+    }
+
+
+def get_transactions(db, iban, limit, before=None):
+    # Keyset pagination, newest first: each side of the UNION walks its own
+    # (iban, id) index from `before` downwards and stops after `limit` rows,
+    # so every page costs the same no matter how deep it is. UNION rather than
+    # UNION ALL drops the duplicate of a transfer to the same IBAN.
+    branches = []
+    for column in (models.Transaction.from_iban, models.Transaction.to_iban):
+        query = select(models.Transaction.__table__).where(column == iban)
+        if before is not None:
+            query = query.where(models.Transaction.id < before)
+        branches.append(select(query.order_by(models.Transaction.id.desc()).limit(limit).subquery()))
+    page = union(*branches).subquery()
+    rows = db.execute(select(page).order_by(page.c.id.desc()).limit(limit)).all()
+    return [transaction_response(row) for row in rows]
+
+
+def create_account(db, user_id, username, kontostand=INITIAL_BALANCE):
+    iban = make_iban(username, user_id)
+    db.execute(insert(models.Account).values(iban=iban, kontostand=kontostand, owner_id=user_id))
+    aggregates.record(db, [(None, kontostand)])
+    return iban
+
+
+def register_users_bulk(db, users):
+    # Multi-row INSERT ... RETURNING for the users, then one multi-row insert
+    # for their accounts per chunk, committed as a single transaction.
+    accounts = []
+    for start in range(0, len(users), BULK_INSERT_CHUNK_SIZE):
+        chunk = users[start:start + BULK_INSERT_CHUNK_SIZE]
+        rows = db.execute(
+            insert(models.User).returning(models.User.id, models.User.username),
+            chunk,
+        ).all()
+        new_accounts = [
+            {"iban": make_iban(row.username, row.id), "kontostand": INITIAL_BALANCE, "owner_id": row.id}
+            for row in rows
+        ]
+        if new_accounts:
+            db.execute(insert(models.Account), new_accounts)
+            aggregates.record(db, [(None, account["kontostand"]) for account in new_accounts])
+        accounts.extend({"username": row.username, "IBAN": account["iban"]} for row, account in zip(rows, new_accounts))
+    db.commit()
+    return accounts
@@ -0,0 +1,117 @@
+import asyncio
+import os
+import signal
+
+DEBUG_TIMEOUT_SECONDS = float(os.environ.get("DEBUG_TIMEOUT_SECONDS", "30"))
+DEBUG_MAX_CONCURRENCY = int(os.environ.get("DEBUG_MAX_CONCURRENCY", "4"))
+DEBUG_MAX_OUTPUT_BYTES = int(os.environ.get("DEBUG_MAX_OUTPUT_BYTES", str(1024 * 1024)))
+CHUNK_SIZE = 64 * 1024
+KILL_GRACE_SECONDS = 5
+
+# (loop, semaphore). Python 3.9 binds asyncio primitives to the loop that is
+# current when they are created, so the semaphore is made on first use in the
+# loop that serves the requests.
+_slots = (None, None)
+
+
+class CommandResult:
+    def __init__(self):
+        self.returncode = None
+        self.timed_out = False
+        self.truncated = False
+
+
+def slots():
+    global _slots
+    loop = asyncio.get_running_loop()
+    if _slots[0] is not loop:
+        _slots = (loop, asyncio.Semaphore(DEBUG_MAX_CONCURRENCY))
+    return _slots[1]
+
+
+def busy():
+    return slots().locked()
+
+
+async def reap(process):
+    # asyncio only reports the exit once the stdout pipe is closed as well,
+    # so whatever is left in it has to be read first.
+    while await process.stdout.read(CHUNK_SIZE):
+        pass
+    await process.wait()
+
+
+def kill_group(process):
+    # The command runs in its own session, so this also kills everything the
+    # shell started, not just the shell.
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def run_command(command, result, timeout=DEBUG_TIMEOUT_SECONDS, max_output=DEBUG_MAX_OUTPUT_BYTES):
+    # Yields stdout and stderr (merged, like check_output with stderr=STDOUT)
+    # as it arrives. The process group is killed on timeout, once max_output
+    # bytes have been read, or when the consumer goes away.
+    async with slots():
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        process = await asyncio.create_subprocess_shell(
+            command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True,
+        )
+        size = 0
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(process.stdout.read(CHUNK_SIZE), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    result.timed_out = True
+                    return
+                if not chunk:
+                    break
+                if size + len(chunk) > max_output:
+                    chunk = chunk[:max_output - size]
+                    result.truncated = True
+                size += len(chunk)
+                if chunk:
+                    yield chunk
+                if result.truncated:
+                    return
+            try:
+                await asyncio.wait_for(process.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                result.timed_out = True
+        finally:
+            if process.returncode is None:
+                kill_group(process)
+            try:
+                await asyncio.wait_for(reap(process), KILL_GRACE_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            result.returncode = process.returncode
+
+
+def status_line(result, timeout=DEBUG_TIMEOUT_SECONDS, max_output=DEBUG_MAX_OUTPUT_BYTES):
+    if result.timed_out:
+        return f"[timed out after {timeout:g}s]"
+    if result.truncated:
+        return f"[output truncated at {max_output} bytes]"
+    return f"[exit code {result.returncode}]"
+
+
+async def stream_command(command):
+    result = CommandResult()
+    async for chunk in run_command(command, result):
+        yield chunk
+    yield f"\n{status_line(result)}\n".encode()
+
+
+async def collect_command(command):
+    result = CommandResult()
+    chunks = [chunk async for chunk in run_command(command, result)]
+    return b"".join(chunks).decode("utf-8", errors="replace"), result
@@ -0,0 +1,110 @@
+import csv
+import io
+import json
+import os
+import zlib
+from sqlalchemy import select
+from . import models
+from .database import replicas
+from .sharding import SHARD_ACCOUNTS, shards
+
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "5000"))
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def accounts_query():
+    return (
+        select(
+            models.Account.id,
+            models.Account.iban,
+            models.Account.kontostand,
+            models.Account.owner_id,
+            models.User.username.label("owner"),
+            models.User.vorname,
+            models.User.nachname,
+            models.User.email,
+        )
+        .outerjoin(models.User, models.Account.owner_id == models.User.id)
+        .order_by(models.Account.id)
+    )
+
+
+def transactions_query():
+    return select(models.Transaction.__table__).order_by(models.Transaction.id)
+
+
+TABLES = {"accounts": accounts_query, "transactions": transactions_query}
+
+
+def json_value(value):
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+def encode_ndjson(columns, rows):
+    return "".join(json.dumps(dict(zip(columns, row)), default=json_value) + "\n" for row in rows).encode()
+
+
+def encode_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def fetch_batches(read_engine, query, batch_size=EXPORT_BATCH_SIZE):
+    # yield_per turns on stream_results: psycopg2 reads through a named
+    # (server-side) cursor, so only one batch of rows is held in memory and
+    # the first batch is sent while the database is still producing the rest.
+    with read_engine.connect() as conn:
+        yield from conn.execution_options(yield_per=batch_size).execute(query).partitions()
+
+
+def sharded_account_batches():
+    # The shards have no users table, the owner columns of each batch are
+    # looked up with one query.
+    query = select(SHARD_ACCOUNTS.c.id, SHARD_ACCOUNTS.c.iban, SHARD_ACCOUNTS.c.kontostand, SHARD_ACCOUNTS.c.owner_id).order_by(SHARD_ACCOUNTS.c.id)
+    for shard_engine in shards.engines:
+        for rows in fetch_batches(shard_engine, query):
+            owner_ids = {row.owner_id for row in rows if row.owner_id is not None}
+            with replicas.read_engine().connect() as conn:
+                owners = {
+                    row.id: tuple(row)[1:]
+                    for row in conn.execute(select(models.User.id, models.User.username, models.User.vorname, models.User.nachname, models.User.email).where(models.User.id.in_(owner_ids)))
+                }
+            yield [tuple(row) + owners.get(row.owner_id, (None, None, None, None)) for row in rows]
+
+
+def sharded_transaction_batches():
+    # A cross-shard transfer is on both shards, it is exported from the sender's.
+    for shard, shard_engine in enumerate(shards.engines):
+        for rows in fetch_batches(shard_engine, transactions_query()):
+            yield [row for row in rows if shards.index(row.from_iban) == shard]
+
+
+SHARDED_TABLES = {"accounts": sharded_account_batches, "transactions": sharded_transaction_batches}
+
+
+def export_rows(columns, batches, output_format):
+    if output_format == "csv":
+        yield encode_csv([columns])
+    for rows in batches:
+        if rows:
+            yield encode_ndjson(columns, rows) if output_format == "ndjson" else encode_csv(rows)
+
+
+def gzip_chunks(chunks):
+    # Each batch is flushed so the client is not kept waiting on zlib's buffer.
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def stream_export(table, output_format, use_gzip=False):
+    # Exports read from a replica when there is one.
+    query = TABLES[table]()
+    batches = SHARDED_TABLES[table]() if shards.enabled else fetch_batches(replicas.read_engine(), query)
+    chunks = export_rows(list(query.selected_columns.keys()), batches, output_format)
+    if use_gzip:
+        chunks = gzip_chunks(chunks)
+    return chunks
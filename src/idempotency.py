@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import time
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+from . import models
+from .cache import TTLCache
+from .transfers import TransferError
+
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_KEY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_CACHE_TTL_SECONDS = float(os.environ.get("IDEMPOTENCY_CACHE_TTL_SECONDS", "300"))
+IDEMPOTENCY_CACHE_MAX_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_MAX_SIZE", "10000"))
+IDEMPOTENCY_PURGE_INTERVAL_SECONDS = 60
+MAX_KEY_LENGTH = 255
+
+# Keys are scoped per user. The LRU answers repeats without a query, and its
+# single-flight makes concurrent duplicates wait for the original request.
+# The table makes keys survive restarts and is shared by all workers.
+responses = TTLCache(min(IDEMPOTENCY_CACHE_TTL_SECONDS, IDEMPOTENCY_KEY_TTL_SECONDS), IDEMPOTENCY_CACHE_MAX_SIZE)
+_last_purge = 0
+
+
+class IdempotencyKeyReused(Exception):
+    pass
+
+
+class IdempotencyKeyInProgress(Exception):
+    pass
+
+
+def fingerprint(*parts):
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def load_stored(db, username, key, now, request_fingerprint):
+    row = db.execute(
+        select(models.IdempotencyKey.fingerprint, models.IdempotencyKey.status_code, models.IdempotencyKey.response)
+        .where(models.IdempotencyKey.username == username)
+        .where(models.IdempotencyKey.key == key)
+        .where(models.IdempotencyKey.created_at >= now - IDEMPOTENCY_KEY_TTL_SECONDS)
+    ).first()
+    if row is None:
+        return None
+    if row.status_code is None:
+        # Reserved by a request that has not finished (see execute_reserved).
+        # Raised inside the loader, so the LRU does not keep it.
+        if row.fingerprint != request_fingerprint:
+            raise IdempotencyKeyReused()
+        raise IdempotencyKeyInProgress()
+    return {"fingerprint": row.fingerprint, "status_code": row.status_code, "body": json.loads(row.response)}
+
+
+def delete_expired(db, username, key, now):
+    # An expired row that has not been purged yet would block the insert.
+    db.execute(
+        delete(models.IdempotencyKey)
+        .where(models.IdempotencyKey.username == username)
+        .where(models.IdempotencyKey.key == key)
+        .where(models.IdempotencyKey.created_at < now - IDEMPOTENCY_KEY_TTL_SECONDS)
+    )
+
+
+def purge_expired(db, now):
+    global _last_purge
+    if now - _last_purge < IDEMPOTENCY_PURGE_INTERVAL_SECONDS:
+        return
+    _last_purge = now
+    db.execute(delete(models.IdempotencyKey).where(models.IdempotencyKey.created_at < now - IDEMPOTENCY_KEY_TTL_SECONDS))
+
+
+def execute_once(db, username, key, request_fingerprint, action, executed):
+    # action(db) does the work without committing and returns the response
+    # body. The key row is committed in the same transaction, so the work is
+    # done exactly once even across workers: a worker that loses the race on
+    # the primary key rolls its work back and answers with the stored row.
+    now = int(time.time())
+    stored = load_stored(db, username, key, now, request_fingerprint)
+    if stored is not None:
+        return stored
+    body = action(db)
+    record = {"fingerprint": request_fingerprint, "status_code": 200, "body": body}
+    purge_expired(db, now)
+    delete_expired(db, username, key, now)
+    db.add(models.IdempotencyKey(username=username, key=key, fingerprint=request_fingerprint, status_code=200, response=json.dumps(body), created_at=now))
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        stored = load_stored(db, username, key, now, request_fingerprint)
+        if stored is None:
+            raise
+        return stored
+    executed.append(True)
+    return record
+
+
+def execute_reserved(db, username, key, request_fingerprint, action, executed):
+    # For work that commits on its own, in another database (cross-shard
+    # transfers): the key is first committed as a pending row (status_code
+    # NULL), so only one worker gets to do the work. A duplicate that arrives
+    # meanwhile gets IdempotencyKeyInProgress. When the work fails before it
+    # changed anything the reservation is dropped and the key can be retried;
+    # after an unexpected error it stays pending until it expires, since the
+    # work may have been done.
+    now = int(time.time())
+    stored = load_stored(db, username, key, now, request_fingerprint)
+    if stored is not None:
+        return stored
+    purge_expired(db, now)
+    delete_expired(db, username, key, now)
+    db.add(models.IdempotencyKey(username=username, key=key, fingerprint=request_fingerprint, created_at=now))
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        stored = load_stored(db, username, key, now, request_fingerprint)
+        if stored is None:
+            raise
+        return stored
+    this_key = (models.IdempotencyKey.username == username) & (models.IdempotencyKey.key == key)
+    try:
+        body = action(db)
+    except TransferError:
+        db.rollback()
+        db.execute(delete(models.IdempotencyKey).where(this_key))
+        db.commit()
+        raise
+    db.execute(update(models.IdempotencyKey).where(this_key).values(status_code=200, response=json.dumps(body)))
+    db.commit()
+    executed.append(True)
+    return {"fingerprint": request_fingerprint, "status_code": 200, "body": body}
+
+
+def checked(record, request_fingerprint, executed):
+    if record["fingerprint"] != request_fingerprint:
+        raise IdempotencyKeyReused()
+    return record, not executed
+
+
+def run_idempotent(db, username, key, request_fingerprint, action, reserve=False):
+    # Returns (record, replayed). reserve is for actions that commit on their
+    # own, see execute_reserved.
+    executed = []
+    execute = execute_reserved if reserve else execute_once
+    record = responses.get_or_load((username, key), lambda: execute(db, username, key, request_fingerprint, action, executed))
+    return checked(record, request_fingerprint, executed)
+
+
+async def arun_idempotent(db, username, key, request_fingerprint, action):
+    executed = []
+    record = await responses.aget_or_load((username, key), lambda: db.run_sync(execute_once, username, key, request_fingerprint, action, executed))
+    return checked(record, request_fingerprint, executed)
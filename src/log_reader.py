@@ -0,0 +1,205 @@
+import asyncio
+import os
+import re
+from collections import deque
+from starlette.concurrency import iterate_in_threadpool
+from .logging_setup import LOG_BACKUP_COUNT, LOG_FILE
+
+CHUNK_SIZE = 64 * 1024
+FOLLOW_POLL_SECONDS = float(os.environ.get("LOG_FOLLOW_POLL_SECONDS", "0.5"))
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# Offsets handed out and accepted by /logs are positions in the concatenation
+# of all files returned by log_files(), oldest backup first.
+
+
+def log_files(path=LOG_FILE, backup_count=LOG_BACKUP_COUNT):
+    files = []
+    for name in [f"{path}.{i}" for i in range(backup_count, 0, -1)] + [path]:
+        try:
+            files.append((name, os.path.getsize(name)))
+        except OSError:
+            continue
+    return files
+
+
+def total_size(files):
+    return sum(size for _, size in files)
+
+
+def parse_range(header, total):
+    match = RANGE_PATTERN.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        return max(total - int(last), 0), total
+    start = int(first)
+    end = total if last == "" else min(int(last) + 1, total)
+    if start >= end:
+        return None
+    return start, end
+
+
+def read_chunks(files, start=0, end=None):
+    position = 0
+    for name, size in files:
+        file_start, position = position, position + size
+        low = max(start, file_start)
+        high = position if end is None else min(end, position)
+        if low >= high:
+            continue
+        with open(name, "rb") as f:
+            f.seek(low - file_start)
+            remaining = high - low
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+def reverse_chunks(files):
+    for name, size in reversed(files):
+        with open(name, "rb") as f:
+            position = size
+            while position > 0:
+                length = min(CHUNK_SIZE, position)
+                position -= length
+                f.seek(position)
+                yield f.read(length)
+
+
+def tail_offset(files, lines):
+    # Seeks backwards from the end until `lines` line starts have been seen.
+    position = total_size(files)
+    if lines <= 0:
+        return position
+    seen = 0
+    trailing = True
+    for chunk in reverse_chunks(files):
+        position -= len(chunk)
+        index = len(chunk)
+        if trailing:
+            trailing = False
+            if chunk.endswith(b"\n"):
+                index -= 1
+        while True:
+            index = chunk.rfind(b"\n", 0, index)
+            if index < 0:
+                break
+            seen += 1
+            if seen == lines:
+                return position + index + 1
+    return 0
+
+
+def reverse_lines(files):
+    pending = b""
+    for chunk in reverse_chunks(files):
+        lines = (chunk + pending).split(b"\n")
+        pending = lines[0]
+        for line in reversed(lines[1:]):
+            yield line
+    if pending:
+        yield pending
+
+
+class LineFilter:
+    def __init__(self, level=None, contains=None):
+        level = level.upper() if level else None
+        # Matches both the text format and LOG_FORMAT=json.
+        self.level_markers = (f" - {level} - ".encode(), f'"level": "{level}"'.encode()) if level else None
+        self.contains = contains.encode() if contains else None
+        self.pending = b""
+
+    @property
+    def active(self):
+        return self.level_markers is not None or self.contains is not None
+
+    def matches(self, line):
+        if self.level_markers and not any(marker in line for marker in self.level_markers):
+            return False
+        if self.contains and self.contains not in line:
+            return False
+        return True
+
+    def feed(self, chunk):
+        if not self.active:
+            return chunk
+        lines = (self.pending + chunk).split(b"\n")
+        self.pending = lines.pop()
+        return b"".join(line + b"\n" for line in lines if self.matches(line))
+
+    def flush(self):
+        rest, self.pending = self.pending, b""
+        if rest and self.matches(rest):
+            return rest
+        return b""
+
+
+def stream_log(files, start, end, line_filter, flush=True):
+    for chunk in read_chunks(files, start, end):
+        data = line_filter.feed(chunk)
+        if data:
+            yield data
+    data = line_filter.flush() if flush else b""
+    if data:
+        yield data
+
+
+def stream_tail_filtered(files, lines, line_filter):
+    # Only the last `lines` matching lines are kept, not the whole log.
+    matched = deque(maxlen=lines)
+    for line in reverse_lines(files):
+        if line and line_filter.matches(line):
+            matched.append(line)
+            if len(matched) == lines:
+                break
+    while matched:
+        yield matched.pop() + b"\n"
+
+
+def live_position(files, path=LOG_FILE):
+    if files and files[-1][0] == path:
+        return files[-1][1]
+    return 0
+
+
+async def follow_log(initial, line_filter, position, path=LOG_FILE, poll_interval=FOLLOW_POLL_SECONDS):
+    # Streams `initial` (the snapshot part), then keeps reading the live log
+    # file from `position`. When the handler rotates it, the rest of the old
+    # file is read through the still open descriptor before the new file is
+    # opened.
+    async for chunk in iterate_in_threadpool(initial):
+        yield chunk
+    f = None
+    try:
+        while True:
+            if f is None:
+                try:
+                    f = open(path, "rb")
+                except OSError:
+                    await asyncio.sleep(poll_interval)
+                    continue
+                f.seek(position)
+            chunk = f.read(CHUNK_SIZE)
+            if chunk:
+                data = line_filter.feed(chunk)
+                if data:
+                    yield data
+                continue
+            try:
+                rotated = os.stat(path).st_ino != os.fstat(f.fileno()).st_ino
+            except OSError:
+                rotated = True
+            if rotated:
+                f.close()
+                f = None
+                position = 0
+                continue
+            await asyncio.sleep(poll_interval)
+    finally:
+        if f is not None:
+            f.close()
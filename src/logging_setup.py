@@ -0,0 +1,159 @@
+import atexit
+import json
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_FILE = os.environ.get("LOG_FILE", "app.log")
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", "3"))
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_OVERFLOW = os.environ.get("LOG_OVERFLOW", "drop")
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", "256"))
+
+# Loggers whose handlers are moved behind the queue. The ones mapped to True
+# also write to LOG_FILE, like before.
+ROUTED_LOGGERS = {"": True, "uvicorn": False, "uvicorn.access": True, "uvicorn.error": True}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class BatchedRotatingFileHandler(RotatingFileHandler):
+    # StreamHandler.emit flushes after every record. The listener thread calls
+    # flush() once per batch instead.
+    def emit(self, record):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class RoutedQueueHandler(QueueHandler):
+    # Request threads only pay for a put on the queue. Formatting happens on
+    # the listener thread, which hands the record to the handlers of `route`.
+    def __init__(self, log_queue, route, pipeline):
+        super().__init__(log_queue)
+        self.route = route
+        self.pipeline = pipeline
+
+    def prepare(self, record):
+        # A record propagating through several routed loggers is enqueued once
+        # per logger, so the route travels next to the record, not on it.
+        return self.route, record
+
+    def enqueue(self, record):
+        if self.pipeline.overflow == "block":
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.pipeline.dropped += 1
+
+
+class RoutingQueueListener(QueueListener):
+    def __init__(self, log_queue, routes, batch_size):
+        super().__init__(log_queue)
+        self.routes = routes
+        self.batch_size = batch_size
+        self.flush_handlers = list({id(h): h for handlers in routes.values() for h in handlers}.values())
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+    def handle(self, item):
+        route, record = item
+        for handler in self.routes.get(route, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        log_queue = self.queue
+        while True:
+            batch = [log_queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(log_queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = False
+            for item in batch:
+                if item is self._sentinel:
+                    stop = True
+                else:
+                    self.handle(item)
+                log_queue.task_done()
+            for handler in self.flush_handlers:
+                handler.flush()
+            if stop:
+                return
+
+
+class LogPipeline:
+    def __init__(self, overflow=LOG_OVERFLOW, queue_size=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE):
+        if overflow not in ("drop", "block"):
+            raise ValueError(f"Unknown LOG_OVERFLOW: {overflow}")
+        self.overflow = overflow
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.listener = None
+
+    def start(self, file_handler):
+        routes = {}
+        for name, to_file in ROUTED_LOGGERS.items():
+            logger = logging.getLogger(name)
+            handlers = [h for h in logger.handlers if not isinstance(h, QueueHandler)]
+            for handler in handlers:
+                logger.removeHandler(handler)
+            if to_file:
+                handlers.append(file_handler)
+            if handlers:
+                routes[name] = handlers
+                logger.addHandler(RoutedQueueHandler(self.queue, name, self))
+        self.listener = RoutingQueueListener(self.queue, routes, self.batch_size)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self.listener is not None and self.listener._thread is not None:
+            self.listener.stop()
+
+    def stats(self):
+        return {"queued": self.queue.qsize(), "queue_size": self.queue.maxsize, "dropped": self.dropped}
+
+
+pipeline = None
+
+
+def configure_logging():
+    global pipeline
+    if pipeline is not None:
+        return pipeline
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    file_handler = BatchedRotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    file_handler.setFormatter(formatter)
+    logging.getLogger().setLevel(logging.INFO)
+    pipeline = LogPipeline()
+    pipeline.start(file_handler)
+    return pipeline
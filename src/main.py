@@ -1,30 +1,39 @@
-from fastapi import FastAPI, Depends, HTTPException, Response, Request
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, FastAPI, Depends, Header, HTTPException, Query, Response, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, text
+from sqlalchemy.exc import IntegrityError
 from fastapi.security import OAuth2PasswordBearer
-from typing import Annotated, List
-from . import models
-from .database import SessionLocal, engine
-import time
+from typing import Annotated, List, Literal, Optional
+from . import aggregates, crud, debug_shell, export, idempotency, log_reader, metrics, models, rate_limit, schema, seeding, sharding, static_assets
+from .cache import account_cache
+from .logging_setup import configure_logging
+from .database import DB_MODE, THREADPOOL_SIZE, AsyncSessionLocal, SessionLocal, async_engine, engine, pool_stats, replicas, wait_for_database, write_pins
+from .tokens import create_token_store, current_unix_minute
+from .transfers import TRANSFER_BATCH_MAX_SIZE, TransferError, execute_transfer
+from contextlib import asynccontextmanager
+import anyio
 import logging
-from logging.handlers import RotatingFileHandler
-import subprocess
-log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-log_handler = RotatingFileHandler('app.log', maxBytes=1024 * 1024, backupCount=3)
-log_handler.setFormatter(log_formatter)
-root_logger = logging.getLogger()
-root_logger.addHandler(log_handler)
-root_logger.setLevel(logging.INFO)
-uvicorn_access_logger = logging.getLogger("uvicorn.access")
-uvicorn_access_logger.addHandler(log_handler)
-uvicorn_error_logger = logging.getLogger("uvicorn.error")
-uvicorn_error_logger.addHandler(log_handler)
-models.Base.metadata.create_all(bind=engine)
-app = FastAPI()
-valid_tokens = ["alice:1760356500"]
-@app.exception_handler(Exception)
+# Importing this module does not connect to a database or open the log file,
+# that happens once in lifespan(). create_app() puts the routers together.
+metrics.instrument_engine(engine)
+if async_engine is not None:
+    metrics.instrument_engine(async_engine.sync_engine)
+for shard_engine in sharding.shards.engines:
+    metrics.instrument_engine(shard_engine)
+for replica in replicas.replicas:
+    metrics.instrument_engine(replica.engine)
+    if replica.async_engine is not None:
+        metrics.instrument_engine(replica.async_engine.sync_engine)
+# /register, /login, /account, /account/{iban} and /transfer exist twice: as
+# sync endpoints on the threadpool and as async endpoints on the event loop.
+# DB_MODE selects which router is mounted.
+api = APIRouter()
+sync_api = APIRouter()
+async_api = APIRouter()
+token_store = create_token_store(static_tokens=["alice:1760356500"])
 async def generic_exception_handler(request: Request, exc: Exception):
     # Log the exception for debugging purposes
     logging.error(f"Unhandled exception: {exc}", exc_info=True)
@@ -32,58 +41,27 @@ async def generic_exception_handler(request: Request, exc: Exception):
         status_code=500,
         content={"message": "Oops sth went wrong... But don't worry your money is safe with us"},
     )
-@app.on_event("startup")
-def startup_event():
-    db = SessionLocal()
-    bob = db.query(models.User).filter(models.User.username == "bob").first()
-    alice = db.query(models.User).filter(models.User.username == "alice").first()
-    if not bob:
-        bob_data = {
-            "username": "bob",
-            "password": "bobpassword",
-            "vorname": "Bob",
-            "nachname": "Builder",
-            "gebdatum": "1990-01-01",
-            "email": "bob@htw.at",
-            "svnummer": "1234567890"
-        }
-        db.execute(text(f"INSERT INTO users (username, password, vorname, nachname, gebdatum, email, svnummer) VALUES ('{bob_data['username']}', '{bob_data['password']}', '{bob_data['vorname']}', '{bob_data['nachname']}', '{bob_data['gebdatum']}', '{bob_data['email']}', '{bob_data['svnummer']}')"))
-        db.commit()
-        new_user = db.query(models.User).filter(models.User.username == "bob").first()
-        if new_user:
-            iban = f"AT{new_user.username[:8].upper()}{str(new_user.id).zfill(3)}"
-            initial_balance = 10000
-            new_account = models.Account(
-                iban=iban,
-                kontostand=initial_balance,
-                owner_id=new_user.id
-            )
-            db.add(new_account)
-            db.commit()
-    if not alice:
-        alice_data = {
-            "username": "alice",
-            "password": "alicepassword",
-            "vorname": "Alice",
-            "nachname": "Wonderland",
-            "gebdatum": "1990-01-01",
-            "email": "alice@htw.at",
-            "svnummer": "0987654321"
-        }
-        db.execute(text(f"INSERT INTO users (username, password, vorname, nachname, gebdatum, email, svnummer) VALUES ('{alice_data['username']}', '{alice_data['password']}', '{alice_data['vorname']}', '{alice_data['nachname']}', '{alice_data['gebdatum']}', '{alice_data['email']}', '{alice_data['svnummer']}')"))
-        db.commit()
-        new_user = db.query(models.User).filter(models.User.username == "alice").first()
-        if new_user:
-            iban = f"AT{new_user.username[:8].upper()}{str(new_user.id).zfill(3)}"
-            initial_balance = 10000
-            new_account = models.Account(
-                iban=iban,
-                kontostand=initial_balance,
-                owner_id=new_user.id
-            )
-            db.add(new_account)
-            db.commit()
-    db.close()
+def startup():
+    configure_logging()
+    for bind in [engine] + sharding.shards.engines:
+        wait_for_database(bind)
+    schema.setup()
+    seeding.seed(engine)
+    sharding.setup()
+    aggregates.reconciler.start(sharding.account_engines())
+    replicas.start()
+def shutdown():
+    replicas.stop()
+    sharding.shards.stop()
+    aggregates.reconciler.stop()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if THREADPOOL_SIZE:
+        anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    static_assets.load_assets(app)
+    startup()
+    yield
+    shutdown()
 class UserRegistration(BaseModel):
     username: str
     password: str
@@ -107,131 +85,357 @@ def get_db():
         yield db
     finally:
         db.close()
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login", auto_error=False)
 def get_current_username(token: Annotated[str, Depends(oauth2_scheme)]):
-    if token not in valid_tokens:
+    username = token_store.lookup(token)
+    if username is None:
         raise HTTPException(status_code=401, detail="Invalid token")
-    try:
-        username, unix_minute_str = token.split(":")
-        unix_minute = int(unix_minute_str)
-    except ValueError:
+    return username
+async def get_current_username_async(token: Annotated[str, Depends(oauth2_scheme)]):
+    username = await token_store.alookup(token)
+    if username is None:
         raise HTTPException(status_code=401, detail="Invalid token")
     return username
-@app.get("/")
+# Rate limits run before the admission limiter and both before the endpoint's
+# own dependencies, so a rejected request never opens a DB session.
+async def limit_transfer(request: Request, username: Annotated[str, Depends(get_current_username_async)]):
+    rate_limit.limit_transfer(request, username)
+# Read-only routes use a replica session. A user who just wrote is pinned to
+# the primary (and past the account cache) for READ_YOUR_WRITES_SECONDS. Reads
+# without a token are never pinned. Without replicas pinning is off.
+async def read_pinned(token: Annotated[Optional[str], Depends(optional_oauth2_scheme)]):
+    if not write_pins.enabled or token is None:
+        return False
+    return write_pins.pinned(await token_store.alookup(token))
+async def pin_to_primary(username: Annotated[str, Depends(get_current_username_async)]):
+    write_pins.pin(username)
+def get_read_db(pinned: Annotated[bool, Depends(read_pinned)]):
+    db = replicas.session(pinned)
+    try:
+        yield db
+    finally:
+        db.close()
+async def get_async_read_db(pinned: Annotated[bool, Depends(read_pinned)]):
+    async with await replicas.async_session(pinned) as db:
+        yield db
+LOGIN_LIMITS = [Depends(rate_limit.limit_login), Depends(rate_limit.admission["login"])]
+TRANSFER_LIMITS = [Depends(limit_transfer), Depends(rate_limit.admission["transfer"])]
+READ_LIMITS = [Depends(rate_limit.admission["read"])]
+WRITES = [Depends(pin_to_primary)]
+@api.get("/")
 def read_root():
     return {"Hello": "World"}
-@app.post("/register")
+def registration_query(user):
+    query = f"INSERT INTO users (username, password, vorname, nachname, gebdatum, email, svnummer) VALUES ('{user.username}', '{user.password}', '{user.vorname}', '{user.nachname}', '{user.gebdatum}', '{user.email}', '{user.svnummer}') RETURNING id, username"
+    return text(query)
+@sync_api.post("/register")
 def register_user(user: UserRegistration, db: Session = Depends(get_db)):
     logging.info(f"New user registration: {user.dict()}")
-    query = f"INSERT INTO users (username, password, vorname, nachname, gebdatum, email, svnummer) VALUES ('{user.username}', '{user.password}', '{user.vorname}', '{user.nachname}', '{user.gebdatum}', '{user.email}', '{user.svnummer}')"
-    db.execute(text(query))
-    db.commit()
-    new_user = db.query(models.User).filter(models.User.username == user.username).first()
+    new_user = db.execute(registration_query(user)).first()
     if not new_user:
         raise HTTPException(status_code=500, detail="User not found after registration")
-    iban = f"AT{new_user.username[:8].upper()}{str(new_user.id).zfill(3)}"
-    initial_balance = 10000
-    new_account = models.Account(
-        iban=iban,
-        kontostand=initial_balance,
-        owner_id=new_user.id
-    )
-    db.add(new_account)
+    iban = sharding.create_account(db, new_user.id, new_user.username)
     db.commit()
-    db.refresh(new_account)
+    account_cache.invalidate(iban)
+    write_pins.pin(new_user.username)
+    return {"message": f"User {user.username} registered successfully with account {iban}. "}
+@async_api.post("/register")
+async def register_user_async(user: UserRegistration, db: AsyncSession = Depends(get_async_db)):
+    logging.info(f"New user registration: {user.dict()}")
+    new_user = (await db.execute(registration_query(user))).first()
+    if not new_user:
+        raise HTTPException(status_code=500, detail="User not found after registration")
+    iban = await db.run_sync(crud.create_account, new_user.id, new_user.username)
+    await db.commit()
+    account_cache.invalidate(iban)
+    write_pins.pin(new_user.username)
     return {"message": f"User {user.username} registered successfully with account {iban}. "}
-@app.post("/login")
+class BulkUserRegistration(BaseModel):
+    users: List[UserRegistration] = Field(..., max_length=crud.REGISTER_BULK_MAX_USERS)
+@api.post("/register/bulk")
+def register_users_bulk(bulk: BulkUserRegistration, username: Annotated[str, Depends(get_current_username)], db: Session = Depends(get_db)):
+    if username != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden. You need to be admin to register users in bulk!")
+    logging.info(f"Bulk user registration: {len(bulk.users)} users")
+    try:
+        accounts = sharding.register_users_bulk(db, [user.dict() for user in bulk.users])
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Username or email already registered")
+    account_cache.invalidate(*(account["IBAN"] for account in accounts))
+    for account in accounts:
+        write_pins.pin(account["username"])
+    return {"message": f"{len(accounts)} users registered successfully.", "accounts": accounts}
+@sync_api.post("/login", dependencies=LOGIN_LIMITS)
 def login_user(user_login: UserLogin, db: Session = Depends(get_db)):
     logging.info(f"Login attempt for user: {user_login.username}, password: {user_login.password}")
     if user_login.username == "admin" and user_login.password == "2148":
-        unix_minute = int(time.time() / 60)
+        unix_minute = current_unix_minute()
         token = f"{user_login.username}:{unix_minute}"
-        valid_tokens.append(token)
+        token_store.add(token)
         return {"token": token}
     db_user = db.query(models.User).filter(models.User.username == user_login.username).first()
     if not db_user or db_user.password != user_login.password:
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    unix_minute = int(time.time() / 60)
+    unix_minute = current_unix_minute()
+    token = f"{user_login.username}:{unix_minute}"
+    token_store.add(token)
+    return {"token": token}
+@async_api.post("/login", dependencies=LOGIN_LIMITS)
+async def login_user_async(user_login: UserLogin, db: AsyncSession = Depends(get_async_db)):
+    logging.info(f"Login attempt for user: {user_login.username}, password: {user_login.password}")
+    if user_login.username == "admin" and user_login.password == "2148":
+        unix_minute = current_unix_minute()
+        token = f"{user_login.username}:{unix_minute}"
+        await token_store.aadd(token)
+        return {"token": token}
+    db_user = (await db.execute(select(models.User).where(models.User.username == user_login.username).limit(1))).scalars().first()
+    if not db_user or db_user.password != user_login.password:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    unix_minute = current_unix_minute()
     token = f"{user_login.username}:{unix_minute}"
-    valid_tokens.append(token)
+    await token_store.aadd(token)
     return {"token": token}
-@app.get("/account", response_model=List[AccountResponse])
-def get_my_accounts(username: Annotated[str, Depends(get_current_username)], db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.username == username).first()
-    if not user:
+@sync_api.get("/account", response_model=List[AccountResponse], dependencies=READ_LIMITS)
+def get_my_accounts(username: Annotated[str, Depends(get_current_username)], db: Session = Depends(get_read_db)):
+    accounts = sharding.get_accounts_for_username(db, username)
+    if accounts is None:
         raise HTTPException(status_code=404, detail="User not found")
-    accounts = db.query(models.Account).filter(models.Account.owner_id == user.id).all()
     if not accounts:
         raise HTTPException(status_code=404, detail="No accounts found for this user")
-    response_accounts = []
-    for account in accounts:
-        response_accounts.append({
-            "IBAN": account.iban,
-            "kontostand": account.kontostand,
-            "owner": account.owner.username
-        })
-    return response_accounts
-@app.get("/account/{iban}", response_model=AccountResponse)
-def get_account_details(iban: str, db: Session = Depends(get_db)):
-    account = db.query(models.Account).filter(models.Account.iban == iban).first()
+    return accounts
+@async_api.get("/account", response_model=List[AccountResponse], dependencies=READ_LIMITS)
+async def get_my_accounts_async(username: Annotated[str, Depends(get_current_username_async)], db: AsyncSession = Depends(get_async_read_db)):
+    accounts = await db.run_sync(crud.get_accounts_for_username, username)
+    if accounts is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    if not accounts:
+        raise HTTPException(status_code=404, detail="No accounts found for this user")
+    return accounts
+@sync_api.get("/account/{iban}", response_model=AccountResponse, dependencies=READ_LIMITS)
+def get_account_details(iban: str, pinned: Annotated[bool, Depends(read_pinned)], db: Session = Depends(get_read_db)):
+    if pinned:
+        account = sharding.get_account_by_iban(db, iban)
+    else:
+        account = account_cache.get_or_load(iban, lambda: sharding.get_account_by_iban(db, iban))
     if not account:
         raise HTTPException(status_code=404, detail="Account not found")
-    return {
-        "IBAN": account.iban,
-        "kontostand": account.kontostand,
-        "owner": account.owner.username
-    }
+    return account
+@async_api.get("/account/{iban}", response_model=AccountResponse, dependencies=READ_LIMITS)
+async def get_account_details_async(iban: str, pinned: Annotated[bool, Depends(read_pinned)], db: AsyncSession = Depends(get_async_read_db)):
+    if pinned:
+        account = await db.run_sync(crud.get_account_by_iban, iban)
+    else:
+        account = await account_cache.aget_or_load(iban, lambda: db.run_sync(crud.get_account_by_iban, iban))
+    if not account:
+        raise HTTPException(status_code=404, detail="Account not found")
+    return account
+@api.get("/account/{iban}/transactions", dependencies=READ_LIMITS)
+def get_account_transactions(iban: str, limit: Annotated[int, Query(ge=1, le=500)] = 50, before: Optional[int] = None, db: Session = Depends(get_read_db)):
+    transactions = sharding.get_transactions(db, iban, limit, before)
+    if not transactions and before is None and sharding.get_account_by_iban(db, iban) is None:
+        raise HTTPException(status_code=404, detail="Account not found")
+    next_before = transactions[-1]["id"] if len(transactions) == limit else None
+    return {"iban": iban, "transactions": transactions, "next_before": next_before}
 class TransferRequest(BaseModel):
     from_iban: str = Field(alias="from")
     to_iban: str = Field(alias="to")
     amount: int
-@app.post("/transfer")
-def transfer_money(transfer_request: TransferRequest, username: Annotated[str, Depends(get_current_username)], db: Session = Depends(get_db)):
-    from_account = db.query(models.Account).filter(models.Account.iban == transfer_request.from_iban).first()
-    if not from_account:
-        raise HTTPException(status_code=404, detail="From account not found")
-    to_account = db.query(models.Account).filter(models.Account.iban == transfer_request.to_iban).first()
-    if not to_account:
-        raise HTTPException(status_code=404, detail="To account not found")
-    MAX_INT = 2147483647
-    MIN_INT = -2147483648
-    new_to_balance = to_account.kontostand + transfer_request.amount
-    if new_to_balance > MAX_INT:
-        new_to_balance = MIN_INT + (new_to_balance - MAX_INT - 1)
-    elif new_to_balance < MIN_INT:
-        new_to_balance = MAX_INT + (new_to_balance - MIN_INT + 1)
-    new_from_balance = from_account.kontostand - transfer_request.amount
-    if new_from_balance < MIN_INT:
-        new_from_balance = MAX_INT + (new_from_balance - MIN_INT + 1)
-    elif new_from_balance > MAX_INT:
-        new_from_balance = MIN_INT + (new_from_balance - MAX_INT - 1)
-    from_account.kontostand = new_from_balance
-    to_account.kontostand = new_to_balance
-    db.commit()
+def transfer_message(transfer_request):
     return {"message": f"Transfer of {transfer_request.amount} from {transfer_request.from_iban} to {transfer_request.to_iban} successful."}
-@app.get("/robots.txt")
-def robots():
-    with open("src/robots.txt", "r") as f:
-        data = f.read()
-    return Response(content=data, media_type="text/plain")
-@app.get("/sitemap.xml")
-def sitemap():
-    with open("src/sitemap.xml", "r") as f:
-        data = f.read()
-    return Response(content=data, media_type="application/xml")
+def check_idempotency_key(idempotency_key):
+    if idempotency_key is not None and not 0 < len(idempotency_key) <= idempotency.MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1 to {idempotency.MAX_KEY_LENGTH} characters")
+def transfer_result(transfer_request, content, replayed):
+    # A replay returns the stored response and leaves accounts and the cache alone.
+    if replayed:
+        return JSONResponse(content=content, headers={"Idempotent-Replayed": "true"})
+    account_cache.invalidate(transfer_request.from_iban, transfer_request.to_iban)
+    return content
+def run_transfer(session, transfer_request):
+    sharding.execute_transfer(session, transfer_request.from_iban, transfer_request.to_iban, transfer_request.amount, commit=False)
+    return transfer_message(transfer_request)
+@sync_api.post("/transfer", dependencies=TRANSFER_LIMITS + WRITES)
+def transfer_money(transfer_request: TransferRequest, username: Annotated[str, Depends(get_current_username)], db: Session = Depends(get_db), idempotency_key: Annotated[Optional[str], Header()] = None):
+    check_idempotency_key(idempotency_key)
+    try:
+        if idempotency_key is None:
+            sharding.execute_transfer(db, transfer_request.from_iban, transfer_request.to_iban, transfer_request.amount)
+            content, replayed = transfer_message(transfer_request), False
+        else:
+            record, replayed = idempotency.run_idempotent(
+                db, username, idempotency_key, idempotency.fingerprint(transfer_request.from_iban, transfer_request.to_iban, transfer_request.amount),
+                lambda session: run_transfer(session, transfer_request),
+                reserve=sharding.shards.enabled,
+            )
+            content = record["body"]
+    except TransferError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except idempotency.IdempotencyKeyReused:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different transfer")
+    except idempotency.IdempotencyKeyInProgress:
+        raise HTTPException(status_code=409, detail="A transfer with this Idempotency-Key is still in progress")
+    return transfer_result(transfer_request, content, replayed)
+@async_api.post("/transfer", dependencies=TRANSFER_LIMITS + WRITES)
+async def transfer_money_async(transfer_request: TransferRequest, username: Annotated[str, Depends(get_current_username_async)], db: AsyncSession = Depends(get_async_db), idempotency_key: Annotated[Optional[str], Header()] = None):
+    check_idempotency_key(idempotency_key)
+    try:
+        if idempotency_key is None:
+            await db.run_sync(execute_transfer, transfer_request.from_iban, transfer_request.to_iban, transfer_request.amount)
+            content, replayed = transfer_message(transfer_request), False
+        else:
+            record, replayed = await idempotency.arun_idempotent(
+                db, username, idempotency_key, idempotency.fingerprint(transfer_request.from_iban, transfer_request.to_iban, transfer_request.amount),
+                lambda session: run_transfer(session, transfer_request),
+            )
+            content = record["body"]
+    except TransferError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except idempotency.IdempotencyKeyReused:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different transfer")
+    return transfer_result(transfer_request, content, replayed)
+class TransferBatchRequest(BaseModel):
+    transfers: List[TransferRequest] = Field(..., max_length=TRANSFER_BATCH_MAX_SIZE)
+    mode: Literal["all-or-nothing", "best-effort"] = "all-or-nothing"
+@api.post("/transfer/batch", dependencies=TRANSFER_LIMITS + WRITES)
+def transfer_money_batch(batch: TransferBatchRequest, username: Annotated[str, Depends(get_current_username)], db: Session = Depends(get_db)):
+    try:
+        committed, results = sharding.execute_transfer_batch(
+            db,
+            [(t.from_iban, t.to_iban, t.amount) for t in batch.transfers],
+            all_or_nothing=batch.mode == "all-or-nothing",
+        )
+    except TransferError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    if committed:
+        account_cache.invalidate(*{iban for t in batch.transfers for iban in (t.from_iban, t.to_iban)})
+    content = {"mode": batch.mode, "committed": committed, "results": results}
+    if not committed:
+        return JSONResponse(status_code=400, content=content)
+    return content
+@api.get("/robots.txt")
+def robots(request: Request):
+    return static_assets.asset_response(static_assets.assets.get("robots.txt"), request)
+@api.get("/sitemap.xml")
+def sitemap(request: Request):
+    return static_assets.asset_response(static_assets.assets.get("sitemap.xml"), request)
 class DebugCommand(BaseModel):
     command: str
-@app.post("/debug")
-def debug(cmd: DebugCommand, username: Annotated[str, Depends(get_current_username)]):
+    stream: bool = False
+@api.post("/debug")
+async def debug(cmd: DebugCommand, username: Annotated[str, Depends(get_current_username_async)]):
     if username != "admin":
         raise HTTPException(status_code=403, detail="Forbidden. You need to be admin to access the root shell!")
-    try:
-        result = subprocess.check_output(cmd.command, shell=True, stderr=subprocess.STDOUT)
-        return {"output": result.decode("utf-8")}
-    except subprocess.CalledProcessError as e:
-        return {"error": e.output.decode("utf-8")}
-@app.get("/logs")
-def logs():
-    with open("app.log", "r") as f:
-        data = f.read()
-    return Response(content=data, media_type="text/plain")
+    if debug_shell.busy():
+        raise HTTPException(status_code=503, detail="Too many debug commands running")
+    if cmd.stream:
+        return StreamingResponse(debug_shell.stream_command(cmd.command), media_type="text/plain")
+    output, result = await debug_shell.collect_command(cmd.command)
+    if result.truncated:
+        return {"output": output, "truncated": True}
+    if result.timed_out:
+        return {"error": output, "timed_out": True}
+    if result.returncode != 0:
+        return {"error": output}
+    return {"output": output}
+@api.get("/export/{table}")
+def export_table(table: Literal["accounts", "transactions"], username: Annotated[str, Depends(get_current_username)], format: Literal["ndjson", "csv"] = "ndjson", gzip: bool = False):
+    if username != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden. You need to be admin to export data!")
+    headers = {"Content-Disposition": f'attachment; filename="{table}.{format}"'}
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(export.stream_export(table, format, use_gzip=gzip), media_type=export.MEDIA_TYPES[format], headers=headers)
+@api.get("/reports/balances", dependencies=READ_LIMITS)
+def balance_report(username: Annotated[str, Depends(get_current_username)], limit: Annotated[int, Query(ge=1, le=aggregates.REPORT_MAX_ACCOUNTS)] = 10, db: Session = Depends(get_read_db)):
+    if username != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden. You need to be admin to see the balance report!")
+    return sharding.balance_report(db, limit)
+@api.get("/logs")
+def logs(request: Request, tail: Annotated[Optional[int], Query(ge=0)] = None, offset: Annotated[Optional[int], Query(ge=0)] = None, level: Optional[str] = None, q: Optional[str] = None, follow: bool = False):
+    files = log_reader.log_files()
+    total = log_reader.total_size(files)
+    line_filter = log_reader.LineFilter(level=level, contains=q)
+    headers = {"Accept-Ranges": "bytes", "X-Log-Size": str(total)}
+    status_code = 200
+    start, end = 0, total
+    range_header = request.headers.get("range")
+    if range_header:
+        byte_range = log_reader.parse_range(range_header, total)
+        if byte_range is None:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{total}"})
+        start, end = byte_range
+        if not line_filter.active and not follow:
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{total}"
+    elif offset is not None:
+        start = min(max(offset, 0), total)
+    elif tail is not None and not line_filter.active:
+        start = log_reader.tail_offset(files, tail)
+    if tail is not None and line_filter.active and not range_header and offset is None:
+        body = log_reader.stream_tail_filtered(files, tail, line_filter)
+    else:
+        body = log_reader.stream_log(files, start, end, line_filter, flush=not follow)
+    if follow:
+        body = log_reader.follow_log(body, line_filter, log_reader.live_position(files))
+    return StreamingResponse(body, status_code=status_code, media_type="text/plain", headers=headers)
+@api.get("/cache/stats")
+def cache_stats():
+    return {"account_cache": account_cache.stats(), "idempotency_cache": idempotency.responses.stats()}
+@api.get("/pool/stats")
+async def db_pool_stats():
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    stats = {
+        "db_pool": pool_stats(engine),
+        "threadpool": {"size": limiter.total_tokens, "busy": limiter.borrowed_tokens},
+    }
+    if async_engine is not None:
+        stats["async_db_pool"] = pool_stats(async_engine.sync_engine)
+    if replicas.replicas:
+        stats["read_replicas"] = replicas.stats()
+        stats["read_your_writes"] = write_pins.stats()
+    if sharding.shards.enabled:
+        stats["shards"] = [dict(pool_stats(shard_engine), **shard) for shard_engine, shard in zip(sharding.shards.engines, sharding.shards.stats())]
+    return stats
+def pool_gauges(name, stats):
+    return [(("pool", "state"), (name, state), stats[state]) for state in ("checked_out", "checked_in", "overflow") if state in stats]
+@api.get("/metrics")
+async def prometheus_metrics():
+    cache = account_cache.stats()
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    pools = pool_gauges("sync", pool_stats(engine))
+    if async_engine is not None:
+        pools += pool_gauges("async", pool_stats(async_engine.sync_engine))
+    for replica in replicas.replicas:
+        pools += pool_gauges(replica.name, pool_stats(replica.engine))
+    for index, shard_engine in enumerate(sharding.shards.engines):
+        pools += pool_gauges(f"shard{index}", pool_stats(shard_engine))
+    log_stats = configure_logging().stats()
+    gauges = [
+        ("account_cache_entries", "Entries in the account cache.", [((), (), cache["size"])]),
+        ("account_cache_events", "Account cache hits, misses, coalesced loads, evictions, expirations and invalidations.",
+         [(("event",), (event,), cache[event]) for event in ("hits", "misses", "coalesced", "evictions", "expirations", "invalidations")]),
+        ("db_pool_connections", "Database pool connections by state.", pools),
+        ("threadpool_busy_threads", "Threads busy running sync endpoints.", [((), (), limiter.borrowed_tokens)]),
+        ("threadpool_size", "Size of the threadpool for sync endpoints.", [((), (), limiter.total_tokens)]),
+        ("db_replica_healthy", "1 if the read replica passed its last health check.", [(("replica",), (replica.name,), int(replica.healthy)) for replica in replicas.replicas]),
+        ("log_queue_records", "Log records waiting to be written.", [((), (), log_stats["queued"])]),
+        ("log_dropped_records", "Log records dropped because the queue was full.", [((), (), log_stats["dropped"])]),
+        ("rate_limit_rejections", "Requests answered with 429, by limiter.", [(("limiter",), (name,), limiter.rejected) for name, limiter in rate_limit.limiters.items()]),
+        ("rate_limit_keys", "Clients tracked by each rate limiter.", [(("limiter",), (name,), limiter.stats()["keys"]) for name, limiter in rate_limit.limiters.items()]),
+        ("admission_in_use", "Requests being processed, by route class.", [(("route_class",), (name,), limiter.in_use) for name, limiter in rate_limit.admission.items()]),
+        ("admission_rejections", "Requests answered with 503, by route class.", [(("route_class",), (name,), limiter.rejected) for name, limiter in rate_limit.admission.items()]),
+    ]
+    return PlainTextResponse(metrics.render(gauges=gauges), media_type="text/plain; version=0.0.4")
+def create_app():
+    app = FastAPI(lifespan=lifespan)
+    app.add_middleware(metrics.MetricsMiddleware)
+    app.add_exception_handler(Exception, generic_exception_handler)
+    app.include_router(api)
+    app.include_router(async_api if DB_MODE == "async" else sync_api)
+    return app
+app = create_app()
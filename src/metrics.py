@@ -0,0 +1,168 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+UNMATCHED_ROUTE = "unmatched"
+
+# All series are written by MetricsMiddleware, which runs on the event loop
+# thread, so recording needs no locks. The SQL hooks run in whichever thread
+# executes the query and only touch the RequestStats of their own request,
+# found through a context variable (copied into the threadpool by Starlette
+# and into the shard executor by sharding.scatter). A scatter read runs them in
+# several threads at once, so those updates take the request's lock.
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds", "lock")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+
+class Registry:
+    def __init__(self):
+        self.in_flight = 0
+        self.requests = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.db_seconds = {}
+
+    def record(self, route, method, status, seconds, stats):
+        key = (route, method, str(status))
+        self.requests[key] = self.requests.get(key, 0) + 1
+        self.latency.observe((route, method), seconds)
+        self.queries.observe((route, method), stats.queries)
+        self.db_seconds[(route, method)] = self.db_seconds.get((route, method), 0.0) + stats.db_seconds
+
+
+registry = Registry()
+
+
+class MetricsMiddleware:
+    def __init__(self, app, registry=registry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        stats = RequestStats()
+        token = current_request.set(stats)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        self.registry.in_flight += 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.registry.in_flight -= 1
+            current_request.reset(token)
+            # The router stores the matched route in the scope. Raw paths are
+            # not used as labels, they would make the series unbounded.
+            route = scope.get("route")
+            route = getattr(route, "path", UNMATCHED_ROUTE)
+            self.registry.record(route, scope["method"], status, time.perf_counter() - started, stats)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.metrics_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_request.get()
+    if stats is not None:
+        seconds = time.perf_counter() - context.metrics_started
+        with stats.lock:
+            stats.queries += 1
+            stats.db_seconds += seconds
+
+
+def instrument_engine(engine):
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=None):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render_histogram(lines, name, help_text, histogram, label_names):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, (counts, total, count) in list(histogram.series.items()):
+        cumulative = 0
+        for bound, bucket_count in zip(histogram.buckets + ("+Inf",), counts):
+            cumulative += bucket_count
+            le = f'le="{bound}"'
+            lines.append(f"{name}_bucket{format_labels(label_names, labels, le)} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(label_names, labels)} {total}")
+        lines.append(f"{name}_count{format_labels(label_names, labels)} {count}")
+
+
+def render_series(lines, name, help_text, metric_type, samples):
+    # samples is a list of (label names, label values, value).
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {metric_type}")
+    for label_names, label_values, value in samples:
+        lines.append(f"{name}{format_labels(label_names, label_values)} {value}")
+
+
+def render(registry=registry, gauges=()):
+    # gauges is a list of (name, help, samples) for values owned by other
+    # modules, e.g. cache and pool statistics.
+    lines = []
+    render_series(lines, "http_requests_in_flight", "Requests currently being served.", "gauge", [((), (), registry.in_flight)])
+    render_series(
+        lines,
+        "http_requests_total",
+        "Requests by route, method and status code.",
+        "counter",
+        [(("route", "method", "status"), key, value) for key, value in list(registry.requests.items())],
+    )
+    render_histogram(lines, "http_request_duration_seconds", "Request latency including the response body.", registry.latency, ("route", "method"))
+    render_histogram(lines, "http_request_db_queries", "SQL statements executed per request.", registry.queries, ("route", "method"))
+    render_series(
+        lines,
+        "http_request_db_seconds_total",
+        "Time spent executing SQL statements, by route.",
+        "counter",
+        [(("route", "method"), key, value) for key, value in list(registry.db_seconds.items())],
+    )
+    for name, help_text, samples in gauges:
+        render_series(lines, name, help_text, "gauge", samples)
+    return "\n".join(lines) + "\n"
@@ -1,7 +1,11 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import BigInteger, Column, DateTime, Integer, Index, String, Text, ForeignKey, func
 from sqlalchemy.orm import relationship
 from .database import Base
 
+# Bump on every change to the tables below, so that the next start runs the
+# schema setup again (see schema.py).
+SCHEMA_VERSION = 3
+
 class User(Base):
     __tablename__ = "users"
 
@@ -16,9 +20,79 @@ class User(Base):
 
 class Account(Base):
     __tablename__ = "accounts"
+    # Top and bottom N by balance read the kontostand index from either end.
+    __table_args__ = (Index("ix_accounts_kontostand", "kontostand"),)
 
     id = Column(Integer, primary_key=True, index=True)
     iban = Column(String, unique=True, index=True)
     kontostand = Column(Integer)
-    owner_id = Column(Integer, ForeignKey("users.id"))
-    owner = relationship("User")
\ No newline at end of file
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+    owner = relationship("User", lazy="joined")
+
+class Token(Base):
+    __tablename__ = "tokens"
+
+    token = Column(String, primary_key=True)
+    username = Column(String)
+    unix_minute = Column(Integer, index=True)
+
+class Transaction(Base):
+    __tablename__ = "transactions"
+    # Append-only. History is read newest first per IBAN, so both sides of a
+    # transfer get an (iban, id) index for keyset pagination.
+    __table_args__ = (
+        Index("ix_transactions_from_iban_id", "from_iban", "id"),
+        Index("ix_transactions_to_iban_id", "to_iban", "id"),
+    )
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    from_iban = Column(String, nullable=False)
+    to_iban = Column(String, nullable=False)
+    amount = Column(BigInteger, nullable=False)
+    from_balance = Column(Integer)
+    to_balance = Column(Integer)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    username = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String)
+    status_code = Column(Integer)
+    response = Column(Text)
+    created_at = Column(Integer, index=True)
+
+class PreparedTransfer(Base):
+    __tablename__ = "prepared_transfers"
+    # Commit decisions of cross-shard transfers: a row exists once all shards
+    # have prepared, until all of them have committed.
+
+    xid = Column(String, primary_key=True)
+    created_at = Column(Integer, index=True)
+
+class IdCounter(Base):
+    __tablename__ = "id_counters"
+    # Last id handed out per name. With shards the account ids come from here,
+    # so they stay unique across the shard databases.
+
+    name = Column(String, primary_key=True)
+    value = Column(BigInteger, nullable=False)
+
+class BalanceStats(Base):
+    __tablename__ = "balance_stats"
+    # Account count and sum of kontostand per balance bucket, kept up to date
+    # by every statement that changes a balance. Writers pick a random stripe
+    # so that concurrent transfers do not queue on one row; readers sum them.
+
+    stripe = Column(Integer, primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    accounts = Column(BigInteger, nullable=False)
+    total = Column(BigInteger, nullable=False)
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+    # One row, the SCHEMA_VERSION the database was last set up with.
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
@@ -0,0 +1,169 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from fastapi import HTTPException, Request
+
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_SWEEP_SECONDS = float(os.environ.get("RATE_LIMIT_SWEEP_SECONDS", "60"))
+ADMISSION_WAIT_SECONDS = float(os.environ.get("ADMISSION_WAIT_SECONDS", "1"))
+
+
+def limit_from_env(name, rate, burst):
+    return (
+        float(os.environ.get(f"{name}_RATE_PER_SECOND", str(rate))),
+        int(os.environ.get(f"{name}_BURST", str(burst))),
+    )
+
+
+class TokenBucketLimiter:
+    # key -> [tokens, last update], in LRU order. A bucket that has been idle
+    # for burst / rate seconds is full again, which is the same as not having
+    # one, so the sweep drops those from the old end.
+    def __init__(self, name, rate, burst, max_keys=RATE_LIMIT_MAX_KEYS, sweep_seconds=RATE_LIMIT_SWEEP_SECONDS):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.sweep_seconds = sweep_seconds
+        self.rejected = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def hit(self, key):
+        # Takes one token. Returns 0 when allowed, otherwise the seconds until
+        # the next token is available.
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep >= self.sweep_seconds:
+                self._sweep(now)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            self.rejected += 1
+            return (1 - bucket[0]) / self.rate
+
+    def _sweep(self, now):
+        self._last_sweep = now
+        idle = self.burst / self.rate
+        while self._buckets:
+            key, (_, last) = next(iter(self._buckets.items()))
+            if now - last < idle:
+                break
+            del self._buckets[key]
+
+    def stats(self):
+        return {"keys": len(self._buckets), "rejected": self.rejected}
+
+
+class AdmissionLimiter:
+    # Caps how many requests of one route class are processed at once. Waits
+    # up to ADMISSION_WAIT_SECONDS for a slot, then answers 503.
+    def __init__(self, name, limit, wait_seconds=ADMISSION_WAIT_SECONDS):
+        self.name = name
+        self.limit = limit
+        self.wait_seconds = wait_seconds
+        self.in_use = 0
+        self.rejected = 0
+        self._loop = None
+        self._slots = None
+
+    def _semaphore(self):
+        # Made on first use in the loop that serves the requests, Python 3.9
+        # binds asyncio primitives to the loop that is current when they are
+        # created.
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._slots = loop, asyncio.Semaphore(self.limit)
+        return self._slots
+
+    async def __call__(self):
+        if self.limit <= 0:
+            yield
+            return
+        slots = self._semaphore()
+        try:
+            await asyncio.wait_for(slots.acquire(), self.wait_seconds)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Server busy, try again later", headers={"Retry-After": "1"})
+        self.in_use += 1
+        try:
+            yield
+        finally:
+            self.in_use -= 1
+            slots.release()
+
+    def stats(self):
+        return {"limit": self.limit, "in_use": self.in_use, "rejected": self.rejected}
+
+
+limiters = {
+    name: TokenBucketLimiter(name, *limit_from_env(name.upper(), rate, burst))
+    for name, rate, burst in (
+        ("login_ip", 10, 50),
+        ("login_user", 1, 5),
+        ("transfer_ip", 50, 100),
+        ("transfer_user", 10, 20),
+    )
+}
+
+admission = {
+    name: AdmissionLimiter(name, int(os.environ.get(f"{name.upper()}_CONCURRENCY", str(limit))))
+    for name, limit in (("read", 32), ("login", 8), ("transfer", 16))
+}
+
+
+def enforce(*checks):
+    # checks are (limiter name, key). Every limiter is charged, so a client is
+    # throttled by whichever of its keys runs out first.
+    if not RATE_LIMIT_ENABLED:
+        return
+    retry_after = 0
+    for name, key in checks:
+        limiter = limiters[name]
+        if limiter.enabled and key is not None:
+            retry_after = max(retry_after, limiter.hit(key))
+    if retry_after:
+        raise HTTPException(status_code=429, detail="Too many requests", headers={"Retry-After": str(math.ceil(retry_after))})
+
+
+def client_ip(request):
+    return request.client.host if request.client else None
+
+
+async def limit_login(request: Request):
+    # FastAPI has already read and parsed the body at this point, this does not
+    # read it a second time.
+    # Only a string is a username. Anything else has no per-user bucket and
+    # gets its 422 from the UserLogin validation.
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    username = body.get("username") if isinstance(body, dict) else None
+    if not isinstance(username, str):
+        username = None
+    enforce(("login_ip", client_ip(request)), ("login_user", username))
+
+
+def limit_transfer(request, username):
+    enforce(("transfer_ip", client_ip(request)), ("transfer_user", username))
+
@@ -0,0 +1,55 @@
+import logging
+import os
+from sqlalchemy import delete, insert, select, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from . import aggregates, models
+from .database import engine
+from .tokens import token_engine
+
+# Set when the tables are managed outside the app, e.g. by a migration step
+# before the rollout. Startup then does not look at the schema at all.
+SKIP_SCHEMA_SETUP = os.environ.get("SKIP_SCHEMA_SETUP", "false").lower() in ("1", "true", "yes")
+# create_all only creates missing tables. Indexes that were added to existing
+# tables later are created here.
+SCHEMA_UPGRADES = [
+    aggregates.BALANCE_INDEX,
+    text("CREATE INDEX IF NOT EXISTS ix_accounts_owner_id ON accounts (owner_id)"),
+]
+# Postgres advisory lock, so that workers starting together set up the schema
+# (and move accounts to their shards) one after the other.
+SCHEMA_LOCK_KEY = 4711
+
+
+def stored_version(bind, version_table):
+    try:
+        with bind.connect() as conn:
+            return conn.execute(select(version_table.c.version)).scalar()
+    except (OperationalError, ProgrammingError):
+        # No schema_version table yet.
+        return None
+
+
+def setup_schema(bind, metadata=models.Base.metadata):
+    # One SELECT when the database is at SCHEMA_VERSION, create_all and the
+    # upgrades only when it is not.
+    if SKIP_SCHEMA_SETUP:
+        return False
+    version_table = metadata.tables[models.SchemaVersion.__tablename__]
+    if stored_version(bind, version_table) == models.SCHEMA_VERSION:
+        return False
+    with bind.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        metadata.create_all(bind=conn)
+        for statement in SCHEMA_UPGRADES:
+            conn.execute(statement)
+        conn.execute(delete(version_table))
+        conn.execute(insert(version_table).values(id=1, version=models.SCHEMA_VERSION))
+    logging.info(f"Schema of {bind.url.render_as_string(hide_password=True)} set up at version {models.SCHEMA_VERSION}")
+    return True
+
+
+def setup():
+    setup_schema(engine)
+    if token_engine is not None and not SKIP_SCHEMA_SETUP:
+        models.Token.__table__.create(bind=token_engine, checkfirst=True)
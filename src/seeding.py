@@ -0,0 +1,203 @@
+import csv
+import io
+import json
+import logging
+import os
+from itertools import islice
+from sqlalchemy import exists, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from . import aggregates, models
+from .crud import INITIAL_BALANCE, make_iban
+
+SEED_FILE = os.environ.get("SEED_FILE")
+SEED_SYNTHETIC_USERS = int(os.environ.get("SEED_SYNTHETIC_USERS", "0"))
+SEED_CHUNK_SIZE = int(os.environ.get("SEED_CHUNK_SIZE", "1000"))
+SEED_COPY_CHUNK_SIZE = int(os.environ.get("SEED_COPY_CHUNK_SIZE", "50000"))
+
+USER_COLUMNS = ("username", "password", "vorname", "nachname", "gebdatum", "email", "svnummer")
+
+DEFAULT_USERS = [
+    {
+        "username": "bob",
+        "password": "bobpassword",
+        "vorname": "Bob",
+        "nachname": "Builder",
+        "gebdatum": "1990-01-01",
+        "email": "bob@htw.at",
+        "svnummer": "1234567890"
+    },
+    {
+        "username": "alice",
+        "password": "alicepassword",
+        "vorname": "Alice",
+        "nachname": "Wonderland",
+        "gebdatum": "1990-01-01",
+        "email": "alice@htw.at",
+        "svnummer": "0987654321"
+    },
+]
+
+# Postgres: COPY into a temp table, then move the rows with two INSERT ...
+# SELECT statements. Users that already exist (same username or email) and
+# users that already own an account are skipped.
+COPY_STAGING_TABLE = text(
+    "CREATE TEMP TABLE seed_users (seq BIGINT, username TEXT, password TEXT, vorname TEXT, nachname TEXT,"
+    " gebdatum TEXT, email TEXT, svnummer TEXT, kontostand INTEGER) ON COMMIT DROP"
+)
+COPY_USERS = text(
+    "INSERT INTO users (username, password, vorname, nachname, gebdatum, email, svnummer)"
+    " SELECT username, password, vorname, nachname, gebdatum, email, svnummer FROM seed_users ORDER BY seq"
+    " ON CONFLICT DO NOTHING"
+)
+COPY_ACCOUNTS = text(
+    "WITH inserted AS ("
+    "INSERT INTO accounts (iban, kontostand, owner_id)"
+    " SELECT 'AT' || upper(left(u.username, 8)) || lpad(u.id::text, greatest(3, length(u.id::text)), '0'), s.kontostand, u.id"
+    " FROM seed_users s JOIN users u ON u.username = s.username"
+    " WHERE NOT EXISTS (SELECT 1 FROM accounts a WHERE a.owner_id = u.id)"
+    " ORDER BY u.id"
+    " ON CONFLICT (iban) DO NOTHING"
+    " RETURNING kontostand"
+    f"), stats AS ({aggregates.POSTGRES_NEW_ACCOUNTS_STATS_UPSERT}) "
+    "SELECT count(*) FROM inserted"
+)
+
+
+def synthetic_users(count):
+    for i in range(1, count + 1):
+        yield {
+            "username": f"user{i:07}",
+            "password": f"password{i}",
+            "vorname": "Load",
+            "nachname": f"Test{i}",
+            "gebdatum": "1990-01-01",
+            "email": f"user{i:07}@loadtest.badbank",
+            "svnummer": f"{i:010}",
+        }
+
+
+def fixture_users(path):
+    with open(path, newline="") as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+
+def last_line(path, block_size=4096):
+    # Reads backwards from the end of the file until it has a whole line.
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        data = b""
+        while end > 0:
+            start = max(0, end - block_size)
+            f.seek(start)
+            data = f.read(end - start) + data
+            end = start
+            stripped = data.rstrip()
+            if b"\n" in stripped:
+                return stripped.rsplit(b"\n", 1)[1].decode()
+        return data.strip().decode()
+
+
+def fixture_bounds(path):
+    # First and last username of a fixture without parsing the rows in
+    # between, so an already seeded file costs next to nothing at startup.
+    with open(path, newline="") as f:
+        if path.endswith(".jsonl"):
+            first = next((json.loads(line) for line in f if line.strip()), None)
+            parse = json.loads
+        else:
+            reader = csv.DictReader(f)
+            first = next(reader, None)
+            parse = lambda line: next(csv.DictReader([line], fieldnames=reader.fieldnames))
+    if first is None:
+        return None, None
+    return first["username"], parse(last_line(path))["username"]
+
+
+def chunked(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def user_row(row):
+    user = {column: row.get(column) for column in USER_COLUMNS}
+    user["kontostand"] = int(row.get("kontostand") or INITIAL_BALANCE)
+    return user
+
+
+def already_seeded(conn, first, last):
+    # Every source is loaded in a single transaction, so if both its first and
+    # its last user exist the whole source is already in the database.
+    usernames = {first, last}
+    found = conn.execute(select(models.User.username).where(models.User.username.in_(usernames))).scalars().all()
+    return len(found) == len(usernames)
+
+
+def copy_users(conn, rows):
+    cursor = conn.connection.driver_connection.cursor()
+    conn.execute(COPY_STAGING_TABLE)
+    seq = 0
+    for chunk in chunked(rows, SEED_COPY_CHUNK_SIZE):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in chunk:
+            seq += 1
+            user = user_row(row)
+            writer.writerow([seq] + [user[column] for column in USER_COLUMNS] + [user["kontostand"]])
+        buffer.seek(0)
+        cursor.copy_expert("COPY seed_users FROM STDIN WITH (FORMAT csv)", buffer)
+    conn.execute(COPY_USERS)
+    return conn.execute(COPY_ACCOUNTS, {"stripe": aggregates.stripe()}).scalar()
+
+
+def upsert_users(conn, rows):
+    insert = postgresql.insert if conn.dialect.name == "postgresql" else sqlite.insert
+    created = 0
+    for chunk in chunked(rows, SEED_CHUNK_SIZE):
+        users = [user_row(row) for row in chunk]
+        balances = {user["username"]: user.pop("kontostand") for user in users}
+        conn.execute(insert(models.User).on_conflict_do_nothing(), users)
+        owners = conn.execute(
+            select(models.User.id, models.User.username)
+            .where(models.User.username.in_(list(balances)))
+            .where(~exists().where(models.Account.owner_id == models.User.id))
+            .order_by(models.User.id)
+        ).all()
+        if owners:
+            accounts = conn.execute(
+                insert(models.Account).on_conflict_do_nothing().returning(models.Account.kontostand),
+                [{"iban": make_iban(o.username, o.id), "kontostand": balances[o.username], "owner_id": o.id} for o in owners],
+            ).scalars().all()
+            aggregates.record(conn, [(None, kontostand) for kontostand in accounts])
+            created += len(owners)
+    return created
+
+
+def seed_users(engine, rows_factory, first, last):
+    with engine.begin() as conn:
+        if already_seeded(conn, first, last):
+            return 0
+        if conn.dialect.driver == "psycopg2":
+            return copy_users(conn, rows_factory())
+        return upsert_users(conn, rows_factory())
+
+
+def seed(engine, seed_file=SEED_FILE, synthetic=SEED_SYNTHETIC_USERS):
+    created = seed_users(engine, lambda: DEFAULT_USERS, DEFAULT_USERS[0]["username"], DEFAULT_USERS[-1]["username"])
+    if seed_file:
+        first, last = fixture_bounds(seed_file)
+        if first is not None:
+            created += seed_users(engine, lambda: fixture_users(seed_file), first, last)
+    if synthetic > 0:
+        created += seed_users(engine, lambda: synthetic_users(synthetic), "user0000001", f"user{synthetic:07}")
+    if created:
+        logging.info(f"Seeded {created} users with accounts")
+    return created
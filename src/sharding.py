@@ -0,0 +1,439 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import Column, Index, MetaData, Table, case, create_engine, delete, func, insert, select, text, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker
+from . import aggregates, crud, models, rate_limit, schema, transfers
+from .database import DB_MODE, THREADPOOL_SIZE, engine, engine_options
+from .transfers import WRAPPED_BALANCE, TransferError, ledger_row, wrap_int32
+
+# Accounts and their ledger rows are spread over these databases by a hash of
+# the IBAN. Users, tokens and idempotency keys stay on DATABASE_URL.
+SHARD_DATABASE_URLS = [url.strip() for url in os.environ.get("SHARD_DATABASE_URLS", "").split(",") if url.strip()]
+# Prepared transactions older than this are resolved, at startup and then
+# every SHARD_RECOVERY_INTERVAL_SECONDS.
+SHARD_RECOVERY_GRACE_SECONDS = int(os.environ.get("SHARD_RECOVERY_GRACE_SECONDS", "60"))
+SHARD_RECOVERY_INTERVAL_SECONDS = float(os.environ.get("SHARD_RECOVERY_INTERVAL_SECONDS", "30"))
+SHARD_MOVE_CHUNK_SIZE = 1000
+XID_PREFIX = "badbank"
+ACCOUNT_ID_COUNTER = "accounts"
+
+# The shards have no users table, so their accounts table is a copy without
+# the foreign key. Each shard keeps the balance stats of its own accounts.
+SHARD_METADATA = MetaData()
+SHARD_ACCOUNTS = Table(
+    "accounts",
+    SHARD_METADATA,
+    *(Column(column.name, column.type, primary_key=column.primary_key, index=column.index, unique=column.unique) for column in models.Account.__table__.columns),
+    Index("ix_accounts_kontostand", "kontostand"),
+)
+SHARD_TRANSACTIONS = models.Transaction.__table__.to_metadata(SHARD_METADATA)
+SHARD_BALANCE_STATS = models.BalanceStats.__table__.to_metadata(SHARD_METADATA)
+models.SchemaVersion.__table__.to_metadata(SHARD_METADATA)
+
+# One leg of a cross-shard transfer, same wraparound as a local transfer.
+LEG_TRANSFER = text(
+    f"UPDATE accounts SET kontostand = {WRAPPED_BALANCE.format(delta='CAST(:delta AS BIGINT)')} "
+    "WHERE accounts.iban = :iban RETURNING accounts.kontostand"
+)
+PREPARED_XIDS = text(
+    "SELECT gid FROM pg_prepared_xacts WHERE database = current_database()"
+    " AND gid LIKE :prefix AND prepared < to_timestamp(:cutoff)"
+)
+
+
+def supports_twophase(shard_engine):
+    if shard_engine.dialect.name != "postgresql":
+        return False
+    with shard_engine.connect() as conn:
+        if int(conn.execute(text("SHOW max_prepared_transactions")).scalar()) > 0:
+            return True
+    logging.warning(f"Shard {shard_engine.url.render_as_string(hide_password=True)} has max_prepared_transactions = 0, cross-shard transfers commit without two-phase commit")
+    return False
+
+
+class ShardRouter:
+    def __init__(self, urls, primary=engine):
+        self.primary = primary
+        self.engines = [create_engine(url, **engine_options(url)) for url in urls]
+        self.sessions = [sessionmaker(autocommit=False, autoflush=False, bind=shard_engine) for shard_engine in self.engines]
+        self.twophase = [False] * len(self.engines)
+        # Every admitted read may scatter to all shards at once. Without an
+        # admission limit the request threadpool (anyio default 40) caps them.
+        readers = rate_limit.admission["read"].limit or THREADPOOL_SIZE or 40
+        self.executor = ThreadPoolExecutor(max_workers=len(self.engines) * readers, thread_name_prefix="shard") if self.engines else None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.engines)
+
+    def index(self, iban):
+        # crc32 rather than hash(), which differs between processes.
+        return zlib.crc32(iban.encode()) % len(self.engines)
+
+    def session(self, iban):
+        return self.sessions[self.index(iban)]()
+
+    def scatter(self, query):
+        # Runs query(session) on every shard in parallel, results in shard order.
+        # Each runs in a copy of the caller's context, so the metrics hooks
+        # count its statements for the calling request.
+        def run(session_factory):
+            with session_factory() as db:
+                return query(db)
+        futures = [self.executor.submit(contextvars.copy_context().run, run, session_factory) for session_factory in self.sessions]
+        return [future.result() for future in futures]
+
+    def setup(self):
+        for shard_engine in self.engines:
+            schema.setup_schema(shard_engine, SHARD_METADATA)
+        self.twophase = [supports_twophase(shard_engine) for shard_engine in self.engines]
+        self.setup_account_ids()
+
+    def setup_account_ids(self):
+        # The counter starts above every account id on the primary and the
+        # shards. Workers starting together only ever raise it.
+        last_ids = []
+        for bind in [self.primary] + self.engines:
+            with bind.connect() as conn:
+                last_ids.append(conn.execute(select(func.max(models.Account.id))).scalar() or 0)
+        floor = max(last_ids)
+        counter = models.IdCounter
+        with self.primary.begin() as conn:
+            create = (postgresql.insert if conn.dialect.name == "postgresql" else sqlite.insert)(counter).values(name=ACCOUNT_ID_COUNTER, value=floor)
+            conn.execute(create.on_conflict_do_nothing(index_elements=["name"]))
+            conn.execute(update(counter).where(counter.name == ACCOUNT_ID_COUNTER).values(value=case((counter.value < floor, floor), else_=counter.value)))
+
+    def allocate_account_ids(self, count):
+        counter = models.IdCounter
+        with self.primary.begin() as conn:
+            last = conn.execute(
+                update(counter).where(counter.name == ACCOUNT_ID_COUNTER).values(value=counter.value + count).returning(counter.value)
+            ).scalar()
+        return range(last - count + 1, last + 1)
+
+    def transfer(self, from_iban, to_iban, amount):
+        shard = self.index(from_iban)
+        if shard == self.index(to_iban):
+            with self.sessions[shard]() as db:
+                return transfers.execute_transfer(db, from_iban, to_iban, amount)
+        return self.transfer_across_shards(from_iban, to_iban, amount)
+
+    def transfer_across_shards(self, from_iban, to_iban, amount):
+        # Both legs run in shard order, so transfers between the same shards
+        # take their row locks in the same order. On Postgres each shard
+        # prepares its part, the decision row on the primary is the commit
+        # point, then the shards commit. Without PREPARE (SQLite, or
+        # max_prepared_transactions = 0) the shards commit one after the other
+        # and a failure in between is only logged.
+        legs = sorted([(self.index(from_iban), from_iban, -amount), (self.index(to_iban), to_iban, amount)])
+        twophase = all(self.twophase[shard] for shard, _, _ in legs)
+        xid = f"{XID_PREFIX}-{uuid.uuid4().hex}"
+        connections = []
+        pending = []
+        decided = False
+        committed = 0
+        try:
+            balances = {}
+            for shard, iban, delta in legs:
+                conn = self.engines[shard].connect()
+                connections.append(conn)
+                pending.append(conn.begin_twophase(f"{xid}-{shard}") if twophase else conn.begin())
+                row = conn.execute(LEG_TRANSFER, {"iban": iban, "delta": delta}).first()
+                if row is not None:
+                    balances[iban] = row.kontostand
+                    aggregates.record(conn, [(wrap_int32(row.kontostand - delta), row.kontostand)])
+            if from_iban not in balances:
+                raise TransferError(404, "From account not found")
+            if to_iban not in balances:
+                raise TransferError(404, "To account not found")
+            # Each shard keeps the ledger row, so an IBAN's history is on its shard.
+            for conn in connections:
+                conn.execute(insert(SHARD_TRANSACTIONS), [ledger_row(from_iban, to_iban, amount, balances)])
+            if twophase:
+                for transaction in pending:
+                    transaction.prepare()
+                self.decide(xid)
+                decided = True
+            while pending:
+                pending[0].commit()
+                pending.pop(0)
+                committed += 1
+            if twophase:
+                self.forget(xid)
+            return balances
+        except Exception:
+            if decided and pending:
+                # Closing would roll the prepared transactions back, they are
+                # committed by recover() instead.
+                for conn in connections:
+                    conn.invalidate()
+                logging.error(f"Cross-shard transfer {xid} is decided but not committed on all shards, it is finished at the next startup")
+            else:
+                if committed:
+                    logging.error(f"Cross-shard transfer {xid} failed after committing {committed} of {len(legs)} shards")
+                for transaction in pending:
+                    transaction.rollback()
+            raise
+        finally:
+            for conn in connections:
+                conn.close()
+
+    def decide(self, xid):
+        with self.primary.begin() as conn:
+            conn.execute(insert(models.PreparedTransfer), {"xid": xid, "created_at": int(time.time())})
+
+    def forget(self, xid):
+        with self.primary.begin() as conn:
+            conn.execute(delete(models.PreparedTransfer).where(models.PreparedTransfer.xid == xid))
+
+    def recover(self, grace_seconds=SHARD_RECOVERY_GRACE_SECONDS):
+        # Finishes transfers interrupted between the two phases: prepared
+        # transactions are committed when their decision row exists and rolled
+        # back otherwise. Younger ones may still be in flight in another worker.
+        # Every worker runs this, a transaction another worker resolved first
+        # is skipped.
+        cutoff = int(time.time()) - grace_seconds
+        resolved = 0
+        for shard_engine, twophase in zip(self.engines, self.twophase):
+            if not twophase:
+                continue
+            with shard_engine.connect() as conn:
+                gids = conn.execute(PREPARED_XIDS, {"prefix": f"{XID_PREFIX}-%", "cutoff": cutoff}).scalars().all()
+            for gid in gids:
+                xid = gid.rsplit("-", 1)[0]
+                with self.primary.connect() as primary:
+                    decided = primary.execute(select(models.PreparedTransfer.xid).where(models.PreparedTransfer.xid == xid)).first() is not None
+                try:
+                    with shard_engine.connect() as conn:
+                        if decided:
+                            conn.commit_prepared(gid, recover=True)
+                        else:
+                            conn.rollback_prepared(gid, recover=True)
+                except SQLAlchemyError as e:
+                    logging.warning(f"Could not resolve prepared cross-shard transfer {gid}: {str(e).splitlines()[0]}")
+                    continue
+                logging.warning(f"{'Committed' if decided else 'Rolled back'} prepared cross-shard transfer {gid}")
+                resolved += 1
+        if any(self.twophase):
+            # A decision row is written after its shards prepared, so one
+            # older than the cutoff belongs to a transaction resolved above.
+            # Another grace period of margin covers clock skew to the shards.
+            with self.primary.begin() as conn:
+                conn.execute(delete(models.PreparedTransfer).where(models.PreparedTransfer.created_at < cutoff - grace_seconds))
+        return resolved
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.recover()
+            except Exception:
+                logging.exception("Recovery of prepared cross-shard transfers failed")
+
+    def start(self, interval=SHARD_RECOVERY_INTERVAL_SECONDS):
+        # setup() already recovered once, this keeps doing it while running.
+        if interval > 0 and any(self.twophase) and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,), name="shard-recovery", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def insert_accounts(self, accounts):
+        # Each shard would number its accounts from 1, the ids are allocated on
+        # the primary instead.
+        by_shard = {}
+        for account, account_id in zip(accounts, self.allocate_account_ids(len(accounts))):
+            by_shard.setdefault(self.index(account["iban"]), []).append(dict(account, id=account_id))
+        for shard, shard_accounts in by_shard.items():
+            with self.engines[shard].begin() as conn:
+                conn.execute(insert(SHARD_ACCOUNTS), shard_accounts)
+                aggregates.record(conn, [(None, account["kontostand"]) for account in shard_accounts])
+
+    def move_from_primary(self, chunk_size=SHARD_MOVE_CHUNK_SIZE):
+        # Every worker runs this at startup. On Postgres they take the schema
+        # lock and move one after the other, the later ones find nothing left.
+        with self.primary.connect() as lock:
+            postgres = lock.dialect.name == "postgresql"
+            if postgres:
+                lock.execute(text("SELECT pg_advisory_lock(:key)"), {"key": schema.SCHEMA_LOCK_KEY})
+                lock.commit()
+            try:
+                return self._move_from_primary(chunk_size, postgres)
+            finally:
+                if postgres:
+                    lock.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": schema.SCHEMA_LOCK_KEY})
+                    lock.commit()
+
+    def _move_from_primary(self, chunk_size, postgres):
+        # Moves accounts (with their ids) and ledger rows that are still on the
+        # primary (from seeding or from before sharding was turned on) to their
+        # shards.
+        # Accounts already on their shard are skipped, so an interrupted move
+        # can be rerun; ledger rows of the chunk in flight would be copied twice.
+        # On SQLite each chunk takes the write lock before reading, so two
+        # workers never move the same rows.
+        moved_accounts = moved_transactions = 0
+        while True:
+            with self.primary.begin() as primary:
+                if not postgres:
+                    primary.execute(transfers.GENERIC_WRITE_LOCK)
+                rows = primary.execute(select(models.Account.__table__).order_by(models.Account.id).limit(chunk_size)).all()
+                if not rows:
+                    break
+                by_shard = {}
+                for row in rows:
+                    by_shard.setdefault(self.index(row.iban), []).append(row)
+                for shard, shard_rows in by_shard.items():
+                    with self.engines[shard].begin() as conn:
+                        existing = set(conn.execute(select(SHARD_ACCOUNTS.c.iban).where(SHARD_ACCOUNTS.c.iban.in_([row.iban for row in shard_rows]))).scalars())
+                        new = [{"id": row.id, "iban": row.iban, "kontostand": row.kontostand, "owner_id": row.owner_id} for row in shard_rows if row.iban not in existing]
+                        if new:
+                            conn.execute(insert(SHARD_ACCOUNTS), new)
+                            aggregates.record(conn, [(None, account["kontostand"]) for account in new])
+                primary.execute(delete(models.Account).where(models.Account.id.in_([row.id for row in rows])))
+                moved_accounts += len(rows)
+        while True:
+            with self.primary.begin() as primary:
+                if not postgres:
+                    primary.execute(transfers.GENERIC_WRITE_LOCK)
+                rows = primary.execute(select(models.Transaction.__table__).order_by(models.Transaction.id).limit(chunk_size)).all()
+                if not rows:
+                    break
+                by_shard = {}
+                for row in rows:
+                    ledger = {column: getattr(row, column) for column in ("from_iban", "to_iban", "amount", "from_balance", "to_balance", "created_at")}
+                    for shard in {self.index(row.from_iban), self.index(row.to_iban)}:
+                        by_shard.setdefault(shard, []).append(ledger)
+                for shard, ledger_rows in by_shard.items():
+                    with self.engines[shard].begin() as conn:
+                        conn.execute(insert(SHARD_TRANSACTIONS), ledger_rows)
+                primary.execute(delete(models.Transaction).where(models.Transaction.id.in_([row.id for row in rows])))
+                moved_transactions += len(rows)
+        if moved_accounts or moved_transactions:
+            logging.info(f"Moved {moved_accounts} accounts and {moved_transactions} transactions from the primary to {len(self.engines)} shards")
+        return moved_accounts, moved_transactions
+
+    def stats(self):
+        return [{"twophase": twophase} for twophase in self.twophase]
+
+
+if SHARD_DATABASE_URLS and DB_MODE != "sync":
+    raise ValueError("SHARD_DATABASE_URLS requires DB_MODE=sync")
+shards = ShardRouter(SHARD_DATABASE_URLS)
+
+
+# The functions below are what the endpoints call. Without shards they are
+# the plain crud/transfers functions on the session they are given.
+
+def setup():
+    if shards.enabled:
+        shards.setup()
+        shards.recover()
+        shards.move_from_primary()
+        shards.start()
+
+
+def get_accounts_for_username(db, username):
+    if not shards.enabled:
+        return crud.get_accounts_for_username(db, username)
+    user_id = db.execute(select(models.User.id).where(models.User.username == username)).scalar()
+    if user_id is None:
+        return None
+    query = select(SHARD_ACCOUNTS.c.iban, SHARD_ACCOUNTS.c.kontostand).where(SHARD_ACCOUNTS.c.owner_id == user_id).order_by(SHARD_ACCOUNTS.c.id)
+    return [crud.account_response(row.iban, row.kontostand, username) for rows in shards.scatter(lambda shard: shard.execute(query).all()) for row in rows]
+
+
+def get_account_by_iban(db, iban):
+    if not shards.enabled:
+        return crud.get_account_by_iban(db, iban)
+    with shards.session(iban) as shard:
+        row = shard.execute(select(SHARD_ACCOUNTS.c.iban, SHARD_ACCOUNTS.c.kontostand, SHARD_ACCOUNTS.c.owner_id).where(SHARD_ACCOUNTS.c.iban == iban)).first()
+    if row is None:
+        return None
+    owner = db.execute(select(models.User.username).where(models.User.id == row.owner_id)).scalar() if row.owner_id is not None else None
+    return crud.account_response(row.iban, row.kontostand, owner)
+
+
+def get_transactions(db, iban, limit, before=None):
+    if not shards.enabled:
+        return crud.get_transactions(db, iban, limit, before)
+    with shards.session(iban) as shard:
+        return crud.get_transactions(shard, iban, limit, before)
+
+
+def create_account(db, user_id, username):
+    # With shards the user is committed on the primary first. If the account
+    # insert fails after that, the user exists without an account.
+    if not shards.enabled:
+        return crud.create_account(db, user_id, username)
+    db.commit()
+    iban = crud.make_iban(username, user_id)
+    shards.insert_accounts([{"iban": iban, "kontostand": crud.INITIAL_BALANCE, "owner_id": user_id}])
+    return iban
+
+
+def register_users_bulk(db, users):
+    if not shards.enabled:
+        return crud.register_users_bulk(db, users)
+    rows = []
+    for start in range(0, len(users), crud.BULK_INSERT_CHUNK_SIZE):
+        rows += db.execute(insert(models.User).returning(models.User.id, models.User.username), users[start:start + crud.BULK_INSERT_CHUNK_SIZE]).all()
+    db.commit()
+    accounts = [{"iban": crud.make_iban(row.username, row.id), "kontostand": crud.INITIAL_BALANCE, "owner_id": row.id} for row in rows]
+    shards.insert_accounts(accounts)
+    return [{"username": row.username, "IBAN": account["iban"]} for row, account in zip(rows, accounts)]
+
+
+def execute_transfer(db, from_iban, to_iban, amount, commit=True):
+    # With shards the transfer always commits on its shards. An idempotency
+    # key is reserved on the primary before it (idempotency.execute_reserved).
+    if not shards.enabled:
+        return transfers.execute_transfer(db, from_iban, to_iban, amount, commit=commit)
+    return shards.transfer(from_iban, to_iban, amount)
+
+
+def execute_transfer_batch(db, batch, all_or_nothing=True):
+    if not shards.enabled:
+        return transfers.execute_transfer_batch(db, batch, all_or_nothing=all_or_nothing)
+    if not batch:
+        return True, []
+    used = {shards.index(iban) for from_iban, to_iban, _ in batch for iban in (from_iban, to_iban)}
+    if len(used) == 1:
+        with shards.sessions[used.pop()]() as shard:
+            return transfers.execute_transfer_batch(shard, batch, all_or_nothing=all_or_nothing)
+    if all_or_nothing:
+        raise TransferError(400, "All-or-nothing batches must stay on one shard, use best-effort")
+    # Best effort across shards: each transfer commits on its own.
+    results = []
+    for index, (from_iban, to_iban, amount) in enumerate(batch):
+        result = {"index": index, "from": from_iban, "to": to_iban, "amount": amount, "status": "ok"}
+        try:
+            shards.transfer(from_iban, to_iban, amount)
+        except TransferError as e:
+            result.update(status="failed", detail=e.detail)
+        results.append(result)
+    return True, results
+
+
+def account_engines():
+    return shards.engines if shards.enabled else [engine]
+
+
+def balance_report(db, limit):
+    if not shards.enabled:
+        return aggregates.report([aggregates.collect(db, limit)], limit)
+    return aggregates.report(shards.scatter(lambda shard: aggregates.collect(shard, limit)), limit)
@@ -0,0 +1,144 @@
+import gzip
+import hashlib
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from types import MappingProxyType
+from xml.sax.saxutils import escape
+from fastapi import Response
+
+STATIC_DIR = Path(__file__).resolve().parent
+STATIC_RELOAD = os.environ.get("STATIC_RELOAD", "false").lower() in ("1", "true", "yes")
+STATIC_RELOAD_INTERVAL_SECONDS = float(os.environ.get("STATIC_RELOAD_INTERVAL_SECONDS", "1"))
+STATIC_CACHE_CONTROL = os.environ.get("STATIC_CACHE_CONTROL", "public, max-age=3600")
+SITEMAP_EXCLUDED_PATHS = ("/robots.txt", "/sitemap.xml")
+
+
+@dataclass(frozen=True)
+class StaticAsset:
+    body: bytes
+    gzip_body: bytes
+    etag: str
+    gzip_etag: str
+    media_type: str
+
+    @classmethod
+    def from_bytes(cls, body, media_type):
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        return cls(
+            body=body,
+            gzip_body=gzip.compress(body, mtime=0),
+            etag=f'"{digest}"',
+            gzip_etag=f'"{digest}-gz"',
+            media_type=media_type,
+        )
+
+
+def etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def accepts_gzip(accept_encoding):
+    # gzip (or its alias x-gzip) with q > 0, or * with q > 0 when gzip is not
+    # listed on its own.
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in qualities:
+            return qualities[coding] > 0
+    return False
+
+
+def asset_response(asset, request):
+    use_gzip = accepts_gzip(request.headers.get("accept-encoding", ""))
+    etag = asset.gzip_etag if use_gzip else asset.etag
+    headers = {"ETag": etag, "Cache-Control": STATIC_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=asset.gzip_body, media_type=asset.media_type, headers=headers)
+    return Response(content=asset.body, media_type=asset.media_type, headers=headers)
+
+
+def build_sitemap(app):
+    # The OpenAPI paths already contain the routes of included routers with
+    # their prefixes and leave out those hidden from the schema.
+    paths = [path for path in app.openapi()["paths"] if path not in SITEMAP_EXCLUDED_PATHS]
+    urls = "".join(f"   <url>\n      <loc>{escape(path)}</loc>\n   </url>\n" for path in paths)
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+        f"{urls}"
+        "</urlset>\n"
+    ).encode()
+
+
+class AssetStore:
+    # Assets are built once and never mutated. A reload swaps in a new
+    # read-only mapping, so request threads read without locking.
+    def __init__(self):
+        self._assets = MappingProxyType({})
+        self._files = {}
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    def get(self, name):
+        return self._assets[name]
+
+    def set(self, name, asset):
+        with self._lock:
+            assets = dict(self._assets)
+            assets[name] = asset
+            self._assets = MappingProxyType(assets)
+
+    def load_file(self, name, path, media_type):
+        path = Path(path)
+        mtime = path.stat().st_mtime_ns
+        self.set(name, StaticAsset.from_bytes(path.read_bytes(), media_type))
+        self._files[name] = (path, media_type, mtime)
+
+    def reload_changed(self):
+        for name, (path, media_type, mtime) in list(self._files.items()):
+            try:
+                if path.stat().st_mtime_ns != mtime:
+                    self.load_file(name, path, media_type)
+            except OSError:
+                continue
+
+    def watch(self, interval=STATIC_RELOAD_INTERVAL_SECONDS):
+        if self._watcher is not None:
+            return
+
+        def poll():
+            while True:
+                time.sleep(interval)
+                self.reload_changed()
+
+        self._watcher = threading.Thread(target=poll, name="static-asset-watcher", daemon=True)
+        self._watcher.start()
+
+
+assets = AssetStore()
+
+
+def load_assets(app):
+    assets.load_file("robots.txt", STATIC_DIR / "robots.txt", "text/plain")
+    assets.set("sitemap.xml", StaticAsset.from_bytes(build_sitemap(app), "application/xml"))
+    if STATIC_RELOAD:
+        assets.watch()
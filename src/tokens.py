@@ -0,0 +1,253 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from starlette.concurrency import run_in_threadpool
+from . import models
+from .database import SessionLocal, engine_options
+
+TOKEN_TTL_MINUTES = int(os.environ.get("TOKEN_TTL_MINUTES", "60"))
+TOKEN_STORE_MAX_SIZE = int(os.environ.get("TOKEN_STORE_MAX_SIZE", "100000"))
+TOKEN_BACKEND = os.environ.get("TOKEN_BACKEND", "memory")
+TOKEN_DATABASE_URL = os.environ.get("TOKEN_DATABASE_URL")
+TOKEN_CACHE_TTL_SECONDS = float(os.environ.get("TOKEN_CACHE_TTL_SECONDS", "30"))
+TOKEN_NEGATIVE_CACHE_TTL_SECONDS = float(os.environ.get("TOKEN_NEGATIVE_CACHE_TTL_SECONDS", "2"))
+TOKEN_CACHE_MAX_SIZE = int(os.environ.get("TOKEN_CACHE_MAX_SIZE", "10000"))
+
+# Its tokens table is created by the schema setup at startup.
+token_engine = create_engine(TOKEN_DATABASE_URL, **engine_options(TOKEN_DATABASE_URL)) if TOKEN_BACKEND == "database" and TOKEN_DATABASE_URL else None
+
+
+def current_unix_minute():
+    return int(time.time() / 60)
+
+
+def parse_token(token):
+    username, unix_minute_str = token.split(":")
+    return username, int(unix_minute_str)
+
+
+class TokenStore:
+    # token -> (username, unix_minute), kept in LRU order. Tokens are parsed once
+    # on insert so lookups never split or convert the token string again.
+    def __init__(self, ttl_minutes=TOKEN_TTL_MINUTES, max_size=TOKEN_STORE_MAX_SIZE, static_tokens=()):
+        self.ttl_minutes = ttl_minutes
+        self.max_size = max_size
+        self._static = {token: parse_token(token) for token in static_tokens}
+        self._tokens = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = current_unix_minute()
+
+    def __len__(self):
+        return len(self._static) + len(self._tokens)
+
+    def __contains__(self, token):
+        return self.lookup(token) is not None
+
+    def _expired(self, unix_minute, now):
+        return self.ttl_minutes > 0 and now - unix_minute > self.ttl_minutes
+
+    def add(self, token):
+        try:
+            entry = parse_token(token)
+        except ValueError:
+            return None
+        now = current_unix_minute()
+        with self._lock:
+            self._tokens[token] = entry
+            self._tokens.move_to_end(token)
+            if now != self._last_sweep:
+                self._sweep(now)
+            while len(self._tokens) > self.max_size:
+                self._tokens.popitem(last=False)
+        return entry[0]
+
+    def lookup(self, token):
+        entry = self._static.get(token)
+        if entry is not None:
+            return entry[0]
+        now = current_unix_minute()
+        with self._lock:
+            entry = self._tokens.get(token)
+            if entry is None:
+                return None
+            if self._expired(entry[1], now):
+                del self._tokens[token]
+                return None
+            self._tokens.move_to_end(token)
+        return entry[0]
+
+    async def aadd(self, token):
+        return self.add(token)
+
+    async def alookup(self, token):
+        return self.lookup(token)
+
+    def discard(self, token):
+        with self._lock:
+            self._tokens.pop(token, None)
+
+    def _sweep(self, now):
+        self._last_sweep = now
+        if self.ttl_minutes <= 0:
+            return
+        expired = [token for token, (_, unix_minute) in self._tokens.items() if self._expired(unix_minute, now)]
+        for token in expired:
+            del self._tokens[token]
+
+
+class DatabaseTokenBackend:
+    # Shared by all uvicorn workers. Point TOKEN_DATABASE_URL at a local SQLite
+    # file to share tokens between workers on one node without Postgres.
+    def __init__(self, session_factory, ttl_minutes=TOKEN_TTL_MINUTES):
+        self.session_factory = session_factory
+        self.ttl_minutes = ttl_minutes
+        self._last_purge = 0
+
+    def add(self, token, username, unix_minute):
+        db = self.session_factory()
+        try:
+            db.add(models.Token(token=token, username=username, unix_minute=unix_minute))
+            try:
+                db.commit()
+            except IntegrityError:
+                db.rollback()
+            now = current_unix_minute()
+            if self.ttl_minutes > 0 and now != self._last_purge:
+                self._last_purge = now
+                db.query(models.Token).filter(models.Token.unix_minute < now - self.ttl_minutes).delete(synchronize_session=False)
+                db.commit()
+        finally:
+            db.close()
+
+    def lookup(self, token):
+        db = self.session_factory()
+        try:
+            row = db.query(models.Token.username, models.Token.unix_minute).filter(models.Token.token == token).first()
+        finally:
+            db.close()
+        if row is None:
+            return None
+        return row.username, row.unix_minute
+
+
+class CachedTokenStore:
+    # Per-worker read-through cache in front of a shared backend. Known tokens
+    # and unknown tokens are both cached briefly, so repeated requests with the
+    # same token do not hit the backend.
+    def __init__(self, backend, ttl_minutes=TOKEN_TTL_MINUTES, cache_ttl=TOKEN_CACHE_TTL_SECONDS,
+                 negative_cache_ttl=TOKEN_NEGATIVE_CACHE_TTL_SECONDS, max_size=TOKEN_CACHE_MAX_SIZE, static_tokens=()):
+        self.backend = backend
+        self.ttl_minutes = ttl_minutes
+        self.cache_ttl = cache_ttl
+        self.negative_cache_ttl = negative_cache_ttl
+        self.max_size = max_size
+        self._static = {token: parse_token(token) for token in static_tokens}
+        self._positive = OrderedDict()
+        self._negative = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._static) + len(self._positive)
+
+    def __contains__(self, token):
+        return self.lookup(token) is not None
+
+    def _remember(self, cache, token, value):
+        cache[token] = value
+        cache.move_to_end(token)
+        while len(cache) > self.max_size:
+            cache.popitem(last=False)
+
+    def add(self, token):
+        try:
+            username, unix_minute = parse_token(token)
+        except ValueError:
+            return None
+        self.backend.add(token, username, unix_minute)
+        self._remember_added(token, username, unix_minute)
+        return username
+
+    async def aadd(self, token):
+        try:
+            username, unix_minute = parse_token(token)
+        except ValueError:
+            return None
+        await run_in_threadpool(self.backend.add, token, username, unix_minute)
+        self._remember_added(token, username, unix_minute)
+        return username
+
+    def _remember_added(self, token, username, unix_minute):
+        with self._lock:
+            self._negative.pop(token, None)
+            self._remember(self._positive, token, (username, unix_minute, time.monotonic() + self.cache_ttl))
+
+    def _cached(self, token, now):
+        # (True, entry) when the local caches know the answer, with entry None
+        # for a cached miss. (False, None) when the backend has to be asked.
+        entry = self._static.get(token)
+        if entry is not None:
+            return True, entry
+        with self._lock:
+            entry = self._positive.get(token)
+            if entry is not None:
+                if entry[2] > now:
+                    return True, entry
+                del self._positive[token]
+            expires = self._negative.get(token)
+            if expires is not None:
+                if expires > now:
+                    return True, None
+                del self._negative[token]
+        return False, None
+
+    def _remember_lookup(self, token, found, now):
+        with self._lock:
+            if found is None:
+                self._remember(self._negative, token, now + self.negative_cache_ttl)
+                return None
+            entry = (found[0], found[1], now + self.cache_ttl)
+            self._remember(self._positive, token, entry)
+            return entry
+
+    def _valid_username(self, token, entry):
+        if entry is None:
+            return None
+        if self.ttl_minutes > 0 and current_unix_minute() - entry[1] > self.ttl_minutes:
+            with self._lock:
+                self._positive.pop(token, None)
+            return None
+        return entry[0]
+
+    def lookup(self, token):
+        now = time.monotonic()
+        known, entry = self._cached(token, now)
+        if not known:
+            entry = self._remember_lookup(token, self.backend.lookup(token), now)
+        return self._valid_username(token, entry)
+
+    async def alookup(self, token):
+        # Only a local cache miss leaves the event loop for the backend.
+        now = time.monotonic()
+        known, entry = self._cached(token, now)
+        if not known:
+            entry = self._remember_lookup(token, await run_in_threadpool(self.backend.lookup, token), now)
+        return self._valid_username(token, entry)
+
+    def discard(self, token):
+        with self._lock:
+            self._positive.pop(token, None)
+
+
+def create_token_store(static_tokens=()):
+    if TOKEN_BACKEND == "memory":
+        return TokenStore(static_tokens=static_tokens)
+    if TOKEN_BACKEND == "database":
+        session_factory = SessionLocal
+        if token_engine is not None:
+            session_factory = sessionmaker(autocommit=False, autoflush=False, bind=token_engine)
+        return CachedTokenStore(DatabaseTokenBackend(session_factory), static_tokens=static_tokens)
+    raise ValueError(f"Unknown TOKEN_BACKEND: {TOKEN_BACKEND}")
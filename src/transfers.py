@@ -0,0 +1,171 @@
+import os
+from sqlalchemy import case, insert, select, text, update
+from . import aggregates, models
+
+MAX_INT = 2147483647
+MIN_INT = -2147483648
+BATCH_UPDATE_CHUNK_SIZE = 500
+# Most transfers in one batch. A batch holds the write locks of all its
+# accounts until it commits. With the default, its at most 500 accounts are
+# written back by a single CASE update.
+TRANSFER_BATCH_MAX_SIZE = int(os.environ.get("TRANSFER_BATCH_MAX_SIZE", "250"))
+
+# Same 32-bit wraparound as wrap_int32, evaluated by the database. The balance
+# is widened to BIGINT first so Postgres does not raise on integer overflow.
+WRAPPED_BALANCE = (
+    "((((CAST(accounts.kontostand AS BIGINT) + {delta}) - (-2147483648)) % 4294967296"
+    " + 4294967296) % 4294967296 + (-2147483648))"
+)
+# The to-account is matched first so that a transfer to the same IBAN ends up
+# with the same balance as the old read-modify-write implementation.
+DELTA = "CASE WHEN accounts.iban = :to_iban THEN CAST(:amount AS BIGINT) ELSE -CAST(:amount AS BIGINT) END"
+
+# Postgres: lock both rows in IBAN order before updating them, so two opposing
+# transfers between the same accounts can never deadlock. The ledger row is
+# written by the same statement and only when both accounts were found, the
+# balance stats are updated by it as well.
+POSTGRES_TRANSFER = text(
+    "WITH locked AS ("
+    " SELECT id, kontostand FROM accounts WHERE iban IN (:from_iban, :to_iban) ORDER BY iban FOR UPDATE"
+    "), moved AS ("
+    f" UPDATE accounts SET kontostand = {WRAPPED_BALANCE.format(delta=DELTA)}"
+    " FROM locked WHERE accounts.id = locked.id"
+    " RETURNING accounts.iban, accounts.kontostand, locked.kontostand AS old_kontostand"
+    "), ledger AS ("
+    " INSERT INTO transactions (from_iban, to_iban, amount, from_balance, to_balance)"
+    " SELECT :from_iban, :to_iban, :amount, f.kontostand, t.kontostand"
+    " FROM moved f JOIN moved t ON f.iban = :from_iban AND t.iban = :to_iban"
+    f"), stats AS ({aggregates.POSTGRES_STATS_UPSERT}) "
+    "SELECT iban, kontostand FROM moved"
+)
+# SQLite serialises writers on the database file, so no row locks are needed.
+# It has no data-modifying CTEs, the ledger row and the stats are separate
+# statements.
+GENERIC_TRANSFER = text(
+    f"UPDATE accounts SET kontostand = {WRAPPED_BALANCE.format(delta=DELTA)} "
+    "WHERE accounts.iban IN (:from_iban, :to_iban) "
+    "RETURNING accounts.iban, accounts.kontostand"
+)
+# pysqlite only opens a transaction on the first write, a SELECT before it
+# reads outside of it. This no-op write takes SQLite's write lock first, so the
+# balances a batch reads cannot change before it writes them back.
+GENERIC_WRITE_LOCK = text("UPDATE accounts SET kontostand = kontostand WHERE 1 = 0")
+
+
+class TransferError(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def wrap_int32(value):
+    return (value - MIN_INT) % 4294967296 + MIN_INT
+
+
+def is_postgres(db):
+    return db.get_bind().dialect.name == "postgresql"
+
+
+def transfer_statement(db):
+    if is_postgres(db):
+        return POSTGRES_TRANSFER
+    return GENERIC_TRANSFER
+
+
+def ledger_row(from_iban, to_iban, amount, balances):
+    return {
+        "from_iban": from_iban,
+        "to_iban": to_iban,
+        "amount": amount,
+        "from_balance": balances[from_iban],
+        "to_balance": balances[to_iban],
+    }
+
+
+def record_transactions(db, rows):
+    if rows:
+        db.execute(insert(models.Transaction), rows)
+
+
+def balance_changes(from_iban, to_iban, amount, balances):
+    # (before, after) per account, worked back from the balances after the
+    # transfer. A transfer to the same IBAN adds the amount, see DELTA.
+    if from_iban == to_iban:
+        return [(wrap_int32(balances[to_iban] - amount), balances[to_iban])]
+    return [
+        (wrap_int32(balances[from_iban] + amount), balances[from_iban]),
+        (wrap_int32(balances[to_iban] - amount), balances[to_iban]),
+    ]
+
+
+def execute_transfer(db, from_iban, to_iban, amount, commit=True):
+    rows = db.execute(
+        transfer_statement(db),
+        {"from_iban": from_iban, "to_iban": to_iban, "amount": amount, "stripe": aggregates.stripe()},
+    ).all()
+    balances = {row.iban: row.kontostand for row in rows}
+    if from_iban not in balances:
+        db.rollback()
+        raise TransferError(404, "From account not found")
+    if to_iban not in balances:
+        db.rollback()
+        raise TransferError(404, "To account not found")
+    if not is_postgres(db):
+        record_transactions(db, [ledger_row(from_iban, to_iban, amount, balances)])
+        aggregates.record(db, balance_changes(from_iban, to_iban, amount, balances))
+    if commit:
+        db.commit()
+    return balances
+
+
+def execute_transfer_batch(db, transfers, all_or_nothing=True):
+    # transfers is a list of (from_iban, to_iban, amount). All involved accounts
+    # are loaded with one IN-query (on Postgres locked in IBAN order, elsewhere
+    # after taking the write lock), the transfers are applied in order in
+    # memory and the changed balances are written back with CASE updates
+    # together with one ledger row per successful transfer, all in a single
+    # transaction.
+    ibans = sorted({iban for from_iban, to_iban, _ in transfers for iban in (from_iban, to_iban)})
+    query = select(models.Account.iban, models.Account.kontostand).where(models.Account.iban.in_(ibans)).order_by(models.Account.iban)
+    if is_postgres(db):
+        query = query.with_for_update()
+    else:
+        db.execute(GENERIC_WRITE_LOCK)
+    balances = {row.iban: row.kontostand for row in db.execute(query)}
+    original = dict(balances)
+    results = []
+    ledger = []
+    for index, (from_iban, to_iban, amount) in enumerate(transfers):
+        result = {"index": index, "from": from_iban, "to": to_iban, "amount": amount, "status": "ok"}
+        if from_iban not in balances:
+            result.update(status="failed", detail="From account not found")
+        elif to_iban not in balances:
+            result.update(status="failed", detail="To account not found")
+        else:
+            new_to_balance = wrap_int32(balances[to_iban] + amount)
+            new_from_balance = wrap_int32(balances[from_iban] - amount)
+            balances[from_iban] = new_from_balance
+            balances[to_iban] = new_to_balance
+            ledger.append(ledger_row(from_iban, to_iban, amount, balances))
+        results.append(result)
+    if all_or_nothing and any(result["status"] == "failed" for result in results):
+        db.rollback()
+        for result in results:
+            if result["status"] == "ok":
+                result["status"] = "rolled_back"
+        return False, results
+    changed = {iban: balance for iban, balance in balances.items() if original[iban] != balance}
+    changed_ibans = list(changed)
+    for start in range(0, len(changed_ibans), BATCH_UPDATE_CHUNK_SIZE):
+        chunk = {iban: changed[iban] for iban in changed_ibans[start:start + BATCH_UPDATE_CHUNK_SIZE]}
+        db.execute(
+            update(models.Account)
+            .where(models.Account.iban.in_(list(chunk)))
+            .values(kontostand=case(chunk, value=models.Account.iban))
+            .execution_options(synchronize_session=False)
+        )
+    record_transactions(db, ledger)
+    aggregates.record(db, [(original[iban], balance) for iban, balance in changed.items()])
+    db.commit()
+    return True, results
@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# src.database builds its engines on import. Point the app at a throwaway
+# SQLite file and log file instead of Postgres and ./app.log.
+TEST_DIR = tempfile.mkdtemp(prefix="badbank-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{TEST_DIR}/badbank.db")
+os.environ.setdefault("LOG_FILE", f"{TEST_DIR}/app.log")
@@ -0,0 +1,89 @@
+import random
+import threading
+from sqlalchemy import create_engine, insert, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from src import aggregates, models
+from src.database import engine_options
+from src.transfers import execute_transfer
+
+BALANCES = [-5, 0, 999, 1000, 10000, 10000, 250000, 2**31 - 1]
+
+
+def setup_engine(tmp_path):
+    url = f"sqlite:///{tmp_path}/aggregates.db"
+    engine = create_engine(url, **engine_options(url))
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(insert(models.Account), [{"iban": f"AT{i}", "kontostand": balance} for i, balance in enumerate(BALANCES)])
+    return engine
+
+
+def stats(engine):
+    with engine.connect() as conn:
+        return {index: value for index, value in aggregates.bucket_stats(conn).items() if value != (0, 0)}
+
+
+def scanned(engine):
+    with engine.connect() as conn:
+        return {row.bucket: (int(row.accounts), int(row.total)) for row in conn.execute(aggregates.RECONCILE_QUERY) if row.scanned}
+
+
+def test_first_build_is_not_drift(tmp_path):
+    engine = setup_engine(tmp_path)
+    assert aggregates.reconcile(engine) is False
+    assert stats(engine) == scanned(engine)
+    assert stats(engine)[0] == (1, -5)
+
+
+def test_drift_is_corrected_once(tmp_path):
+    engine = setup_engine(tmp_path)
+    aggregates.reconcile(engine)
+    with engine.begin() as conn:
+        conn.execute(update(models.BalanceStats).values(accounts=models.BalanceStats.accounts + 2, total=models.BalanceStats.total - 77))
+        aggregates.record(conn, [(None, 123)])
+    assert stats(engine) != scanned(engine)
+    assert aggregates.reconcile(engine) is True
+    assert stats(engine) == scanned(engine)
+    assert aggregates.reconcile(engine) is False
+
+
+def test_reconcile_during_transfers_keeps_the_stats_exact(tmp_path):
+    # Transfers that commit while a reconcile runs add their own change, the
+    # reconcile only adds what was off.
+    engine = setup_engine(tmp_path)
+    aggregates.reconcile(engine)
+    with engine.begin() as conn:
+        conn.execute(update(models.BalanceStats).values(total=models.BalanceStats.total + 1000))
+    Session = sessionmaker(bind=engine)
+    stop = threading.Event()
+    ibans = [f"AT{i}" for i in range(len(BALANCES))]
+
+    def transfer(seed):
+        rng = random.Random(seed)
+        while not stop.is_set():
+            try:
+                with Session() as db:
+                    execute_transfer(db, rng.choice(ibans), rng.choice(ibans), rng.choice([3, 50000, 2**31 - 1]))
+            except OperationalError:
+                pass
+
+    threads = [threading.Thread(target=transfer, args=(seed,)) for seed in range(4)]
+    for thread in threads:
+        thread.start()
+    drift = [aggregates.reconcile(engine) for _ in range(5)]
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert drift[0] is True
+    assert stats(engine) == scanned(engine)
+
+
+def test_reconciler_records_the_result(tmp_path):
+    engine = setup_engine(tmp_path)
+    reconciler = aggregates.Reconciler(interval=0)
+    reconciler.binds = [engine]
+    assert reconciler.leads(engine)
+    reconciler.reconcile()
+    assert aggregates.last_reconcile["drift"] is False
+    assert aggregates.last_reconcile["at"] is not None
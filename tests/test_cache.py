@@ -0,0 +1,152 @@
+import asyncio
+import threading
+import time
+import pytest
+from src import cache
+from src.cache import TTLCache
+
+
+def start_threads(count, target):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_concurrent_misses_share_one_load():
+    ttl_cache = TTLCache(60, 100)
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def loader():
+        calls.append(1)
+        release.wait()
+        return "value"
+
+    threads = start_threads(8, lambda: results.append(ttl_cache.get_or_load("key", loader)))
+    wait_for(lambda: ttl_cache.misses + ttl_cache.coalesced == 8)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == ["value"] * 8
+    assert ttl_cache.get_or_load("key", lambda: "other") == "value"
+
+
+def test_invalidation_during_a_load_is_not_cached():
+    ttl_cache = TTLCache(60, 100)
+    started = threading.Event()
+    release = threading.Event()
+    results = []
+
+    def loader():
+        started.set()
+        release.wait()
+        return "old"
+
+    threads = start_threads(1, lambda: results.append(ttl_cache.get_or_load("key", loader)))
+    started.wait()
+    ttl_cache.invalidate("key")
+    release.set()
+    threads[0].join()
+    # The caller still gets the result, the next one loads again.
+    assert results == ["old"]
+    assert ttl_cache.get_or_load("key", lambda: "new") == "new"
+
+
+def test_failed_load_reaches_waiters_and_is_not_cached():
+    ttl_cache = TTLCache(60, 100)
+    release = threading.Event()
+    errors = []
+
+    def loader():
+        release.wait()
+        raise RuntimeError("down")
+
+    def call():
+        try:
+            ttl_cache.get_or_load("key", loader)
+        except RuntimeError as e:
+            errors.append(e)
+
+    threads = start_threads(4, call)
+    wait_for(lambda: ttl_cache.misses + ttl_cache.coalesced == 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 4
+    assert ttl_cache.get_or_load("key", lambda: "up") == "up"
+
+
+def test_entries_expire_and_are_evicted(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    ttl_cache = TTLCache(5, 2)
+    for key in ("a", "b"):
+        ttl_cache.get_or_load(key, lambda: key)
+    ttl_cache.get_or_load("a", lambda: "reloaded")
+    ttl_cache.get_or_load("c", lambda: "c")
+    assert ttl_cache.evictions == 1
+    assert ttl_cache.get_or_load("b", lambda: "reloaded") == "reloaded"
+    now[0] += 6
+    assert ttl_cache.get_or_load("c", lambda: "expired") == "expired"
+    assert ttl_cache.expirations == 1
+
+
+def test_async_concurrent_misses_share_one_load():
+    ttl_cache = TTLCache(60, 100)
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "value"
+
+    async def main():
+        return await asyncio.gather(*(ttl_cache.aget_or_load("key", loader) for _ in range(8)))
+
+    assert asyncio.run(main()) == ["value"] * 8
+    assert len(calls) == 1
+    assert ttl_cache.coalesced == 7
+
+
+def test_async_invalidation_during_a_load_is_not_cached():
+    ttl_cache = TTLCache(60, 100)
+
+    async def loader():
+        await asyncio.sleep(0.01)
+        return "old"
+
+    async def main():
+        load = asyncio.ensure_future(ttl_cache.aget_or_load("key", loader))
+        await asyncio.sleep(0)
+        ttl_cache.invalidate("key")
+        assert await load == "old"
+
+        async def new():
+            return "new"
+        return await ttl_cache.aget_or_load("key", new)
+
+    assert asyncio.run(main()) == "new"
+
+
+def test_async_failed_load_is_not_cached():
+    ttl_cache = TTLCache(60, 100)
+
+    async def failing():
+        raise RuntimeError("down")
+
+    async def working():
+        return "up"
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(ttl_cache.aget_or_load("key", failing))
+    assert asyncio.run(ttl_cache.aget_or_load("key", working)) == "up"
@@ -0,0 +1,99 @@
+import uuid
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+from src import idempotency, models
+from src.database import SessionLocal
+from src.main import create_app
+
+ALICE = {"Authorization": "Bearer alice:1760356500"}
+TRANSFER = {"from": "ATBOB001", "to": "ATALICE002", "amount": 3}
+
+
+@pytest.fixture
+def client():
+    with TestClient(create_app()) as client:
+        yield client
+
+
+def balance(iban):
+    with SessionLocal() as db:
+        return db.execute(select(models.Account.kontostand).where(models.Account.iban == iban)).scalar()
+
+
+def post(client, key, body=TRANSFER, headers=ALICE):
+    return client.post("/transfer", json=body, headers=dict(headers, **{"Idempotency-Key": key}))
+
+
+def test_repeated_key_is_replayed_and_transfers_once(client):
+    key = str(uuid.uuid4())
+    before = balance("ATBOB001")
+    first = post(client, key)
+    # Once from the worker's LRU, once from the table.
+    second = post(client, key)
+    idempotency.responses.clear()
+    third = post(client, key)
+    assert first.status_code == second.status_code == third.status_code == 200
+    assert "Idempotent-Replayed" not in first.headers
+    assert second.headers["Idempotent-Replayed"] == third.headers["Idempotent-Replayed"] == "true"
+    assert first.json() == second.json() == third.json()
+    assert balance("ATBOB001") == before - 3
+
+
+def test_key_reused_for_another_transfer_is_rejected(client):
+    key = str(uuid.uuid4())
+    assert post(client, key).status_code == 200
+    before = balance("ATBOB001")
+    for cached in (True, False):
+        if not cached:
+            idempotency.responses.clear()
+        response = post(client, key, dict(TRANSFER, amount=4))
+        assert response.status_code == 422
+    assert balance("ATBOB001") == before
+
+
+def test_keys_are_scoped_per_user(client):
+    key = str(uuid.uuid4())
+    token = client.post("/login", json={"username": "bob", "password": "bobpassword"}).json()["token"]
+    before = balance("ATBOB001")
+    assert "Idempotent-Replayed" not in post(client, key).headers
+    assert "Idempotent-Replayed" not in post(client, key, headers={"Authorization": f"Bearer {token}"}).headers
+    assert balance("ATBOB001") == before - 6
+
+
+def test_failed_transfer_does_not_use_up_the_key(client):
+    key = str(uuid.uuid4())
+    assert post(client, key, dict(TRANSFER, to="DOESNOTEXIST")).status_code == 404
+    before = balance("ATBOB001")
+    response = post(client, key)
+    assert response.status_code == 200
+    assert "Idempotent-Replayed" not in response.headers
+    assert balance("ATBOB001") == before - 3
+
+
+def test_key_length_is_checked(client):
+    assert post(client, "x" * (idempotency.MAX_KEY_LENGTH + 1)).status_code == 400
+
+
+def test_pending_reservation_blocks_duplicates():
+    key = str(uuid.uuid4())
+    request_fingerprint = idempotency.fingerprint("ATBOB001", "ATALICE002", 3)
+    seen = []
+
+    def action(db):
+        # While the reserved action runs, its key is pending in the table.
+        with SessionLocal() as other:
+            for other_fingerprint in (request_fingerprint, idempotency.fingerprint("ATBOB001", "ATALICE002", 4)):
+                try:
+                    idempotency.execute_reserved(other, "alice", key, other_fingerprint, lambda db: None, [])
+                except (idempotency.IdempotencyKeyInProgress, idempotency.IdempotencyKeyReused) as e:
+                    seen.append(type(e))
+        return {"message": "done"}
+
+    with SessionLocal() as db:
+        executed = []
+        record = idempotency.execute_reserved(db, "alice", key, request_fingerprint, action, executed)
+    assert seen == [idempotency.IdempotencyKeyInProgress, idempotency.IdempotencyKeyReused]
+    assert record["body"] == {"message": "done"} and executed
+    with SessionLocal() as db:
+        assert idempotency.execute_reserved(db, "alice", key, request_fingerprint, action, [])["body"] == {"message": "done"}
@@ -0,0 +1,80 @@
+import pytest
+from fastapi.testclient import TestClient
+from src import log_reader
+from src.main import create_app
+
+LINES = [f"line {i}".encode() for i in range(20)]
+
+
+@pytest.fixture
+def files(tmp_path, monkeypatch):
+    # Ten lines in the backup, ten in the live file, read in 7-byte chunks so
+    # lines and files span chunk boundaries.
+    monkeypatch.setattr(log_reader, "CHUNK_SIZE", 7)
+    path = tmp_path / "app.log"
+    (tmp_path / "app.log.1").write_bytes(b"".join(line + b"\n" for line in LINES[:10]))
+    path.write_bytes(b"".join(line + b"\n" for line in LINES[10:]))
+    return log_reader.log_files(str(path), backup_count=3)
+
+
+def read(files, start, end=None):
+    return b"".join(log_reader.read_chunks(files, start, end))
+
+
+@pytest.mark.parametrize("lines", [1, 3, 10, 11, 15])
+def test_tail_offset_starts_at_the_nth_last_line(files, lines):
+    assert read(files, log_reader.tail_offset(files, lines)) == b"".join(line + b"\n" for line in LINES[-lines:])
+
+
+def test_tail_offset_bounds(files):
+    total = log_reader.total_size(files)
+    assert log_reader.tail_offset(files, 0) == total
+    assert log_reader.tail_offset(files, 100) == 0
+
+
+def test_tail_offset_without_trailing_newline(tmp_path):
+    path = tmp_path / "app.log"
+    path.write_bytes(b"a\nb\nc")
+    files = log_reader.log_files(str(path), backup_count=0)
+    assert read(files, log_reader.tail_offset(files, 2)) == b"b\nc"
+
+
+def test_read_chunks_spans_the_rotated_files(files):
+    everything = b"".join(line + b"\n" for line in LINES)
+    assert read(files, 0) == everything
+    assert read(files, 60, 80) == everything[60:80]
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-9", (0, 10)),
+    ("bytes=10-", (10, 100)),
+    ("bytes=-30", (70, 100)),
+    ("bytes=-300", (0, 100)),
+    ("bytes=90-500", (90, 100)),
+    (" bytes=5-5 ", (5, 6)),
+])
+def test_parse_range(header, expected):
+    assert log_reader.parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=-", "bytes=100-", "bytes=9-3", "bytes=0-1,5-6", "items=0-1", "bytes=a-b", ""])
+def test_parse_range_rejects_unsatisfiable_and_malformed(header):
+    assert log_reader.parse_range(header, 100) is None
+
+
+def test_filtered_tail_keeps_the_last_matches(files):
+    line_filter = log_reader.LineFilter(contains="1")
+    result = b"".join(log_reader.stream_tail_filtered(files, 3, line_filter))
+    assert result == b"line 17\nline 18\nline 19\n"
+
+
+def test_logs_endpoint_validates_tail_offset_and_range():
+    with TestClient(create_app()) as client:
+        assert client.get("/logs", params={"tail": -1}).status_code == 422
+        assert client.get("/logs", params={"offset": -1}).status_code == 422
+        response = client.get("/logs", headers={"Range": "bytes=9-3"})
+        assert response.status_code == 416
+        assert response.headers["Content-Range"].startswith("bytes */")
+        response = client.get("/logs", headers={"Range": "bytes=0-4"})
+        assert response.status_code == 206
+        assert len(response.content) == 5
@@ -0,0 +1,49 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+from src.database import engine, replicas
+from src.main import create_app
+
+# Maximum number of SQL statements each request may issue. A lazy load or an
+# extra lookup sneaking into one of these paths shows up as a budget overrun.
+# A transfer is one statement on Postgres and three on SQLite, where the ledger
+# row and the balance stats need their own INSERT.
+BUDGETS = [
+    ("GET", "/account", None, 1),
+    ("GET", "/account/ATBOB001", None, 1),
+    ("GET", "/account/DOESNOTEXIST", None, 1),
+    ("POST", "/transfer", {"from": "ATBOB001", "to": "ATALICE002", "amount": 1}, 3),
+    ("POST", "/transfer", {"from": "ATALICE002", "to": "ATBOB001", "amount": 1}, 3),
+    ("GET", "/account/ATBOB001/transactions?limit=10", None, 1),
+]
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(create_app()) as client:
+        token = client.post("/login", json={"username": "bob", "password": "bobpassword"}).json()["token"]
+        client.headers["Authorization"] = f"Bearer {token}"
+        yield client
+
+
+@pytest.fixture
+def statements():
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(" ".join(statement.split()))
+
+    engines = [engine] + [replica.engine for replica in replicas.replicas]
+    for counted_engine in engines:
+        event.listen(counted_engine, "before_cursor_execute", count_statement)
+    yield statements
+    for counted_engine in engines:
+        event.remove(counted_engine, "before_cursor_execute", count_statement)
+
+
+@pytest.mark.parametrize("method, path, body, budget", BUDGETS)
+def test_statements_per_request(client, statements, method, path, body, budget):
+    statements.clear()
+    response = client.request(method, path, json=body)
+    assert response.status_code < 500
+    assert len(statements) <= budget, "\n".join(statements)
@@ -0,0 +1,57 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from src import rate_limit
+from src.main import create_app
+
+
+@pytest.mark.parametrize("body", [
+    {"username": {"a": 1}, "password": "x"},
+    {"username": ["bob"], "password": "x"},
+    [{"username": "bob", "password": "x"}],
+    "bob",
+    42,
+])
+def test_login_with_malformed_body_is_rejected_by_validation(body):
+    with TestClient(create_app()) as client:
+        response = client.post("/login", json=body)
+    assert response.status_code == 422
+
+
+def test_login_with_invalid_json_is_rejected_by_validation():
+    with TestClient(create_app()) as client:
+        response = client.post("/login", content=b"{not json", headers={"Content-Type": "application/json"})
+    assert response.status_code == 422
+
+
+def test_login_user_bucket_is_keyed_on_the_username():
+    limiter = rate_limit.limiters["login_user"]
+    with TestClient(create_app()) as client:
+        client.post("/login", json={"username": "rate-limit-test", "password": "x"})
+        client.post("/login", json={"username": {"a": 1}, "password": "x"})
+    assert "rate-limit-test" in limiter._buckets
+    assert all(isinstance(key, str) for key in limiter._buckets)
+
+
+def test_admission_limiter_works_across_event_loops():
+    # Each TestClient (and each uvicorn start) runs its own loop.
+    limiter = rate_limit.AdmissionLimiter("test", 1, wait_seconds=0.05)
+
+    async def contend():
+        holder = limiter()
+        await holder.__anext__()
+        waiter = limiter()
+        with pytest.raises(HTTPException) as excinfo:
+            await waiter.__anext__()
+        assert excinfo.value.status_code == 503
+        await holder.aclose()
+        await waiter.aclose()
+        admitted = limiter()
+        await admitted.__anext__()
+        await admitted.aclose()
+
+    for _ in range(2):
+        asyncio.run(contend())
+    assert limiter.rejected == 2
+    assert limiter.in_use == 0
@@ -0,0 +1,29 @@
+from fastapi.testclient import TestClient
+from src import crud
+from src.main import create_app
+
+
+def registration(username):
+    return {"username": username, "password": "pw", "vorname": "a", "nachname": "b", "gebdatum": "1990-01-01", "email": f"{username}@bulk.test", "svnummer": "1"}
+
+
+def admin_headers(client):
+    token = client.post("/login", json={"username": "admin", "password": "2148"}).json()["token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_bulk_registration_needs_admin():
+    with TestClient(create_app()) as client:
+        assert client.post("/register/bulk", json={"users": [registration("bulkanon")]}).status_code == 401
+        bob = client.post("/login", json={"username": "bob", "password": "bobpassword"}).json()["token"]
+        response = client.post("/register/bulk", json={"users": [registration("bulkbob")]}, headers={"Authorization": f"Bearer {bob}"})
+        assert response.status_code == 403
+        response = client.post("/register/bulk", json={"users": [registration("bulkadmin")]}, headers=admin_headers(client))
+        assert response.status_code == 200
+        assert [account["username"] for account in response.json()["accounts"]] == ["bulkadmin"]
+
+
+def test_bulk_registration_is_capped():
+    users = [registration(f"bulkcap{i}") for i in range(crud.REGISTER_BULK_MAX_USERS + 1)]
+    with TestClient(create_app()) as client:
+        assert client.post("/register/bulk", json={"users": users}, headers=admin_headers(client)).status_code == 422
@@ -0,0 +1,41 @@
+import pytest
+from fastapi.testclient import TestClient
+from src.main import create_app
+from src.static_assets import accepts_gzip
+
+
+def test_sitemap_lists_routes_of_all_routers():
+    with TestClient(create_app()) as client:
+        response = client.get("/sitemap.xml")
+    assert response.status_code == 200
+    # Routes from the shared router and from the sync/async router.
+    for path in ("/", "/transfer/batch", "/account/{iban}/transactions", "/register", "/login", "/account", "/account/{iban}", "/transfer"):
+        assert f"<loc>{path}</loc>" in response.text
+    assert "<loc>/sitemap.xml</loc>" not in response.text
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("gzip", True),
+    ("gzip, deflate, br", True),
+    ("br;q=1.0, gzip;q=0.8", True),
+    ("GZIP", True),
+    ("x-gzip", True),
+    ("*", True),
+    ("gzip;q=0", False),
+    ("gzip; q=0.0, *", False),
+    ("*;q=0", False),
+    ("x-gzip-foo", False),
+    ("deflate, br", False),
+    ("gzip;q=nonsense", False),
+    ("", False),
+])
+def test_accepts_gzip(header, expected):
+    assert accepts_gzip(header) is expected
+
+
+def test_gzip_refused_with_q_zero_is_not_sent():
+    with TestClient(create_app()) as client:
+        refused = client.get("/robots.txt", headers={"Accept-Encoding": "gzip;q=0, identity"})
+        accepted = client.get("/robots.txt", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in refused.headers
+    assert accepted.headers["Content-Encoding"] == "gzip"
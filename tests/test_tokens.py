@@ -0,0 +1,82 @@
+from src import tokens
+from src.tokens import CachedTokenStore, TokenStore
+
+
+def test_expired_tokens_are_rejected(monkeypatch):
+    monkeypatch.setattr(tokens, "current_unix_minute", lambda: 1000)
+    store = TokenStore(ttl_minutes=60)
+    assert store.add("bob:1000") == "bob"
+    assert store.add("old:900") == "old"
+    assert store.lookup("bob:1000") == "bob"
+    assert store.lookup("old:900") is None
+    assert len(store) == 1
+
+
+def test_sweep_drops_expired_tokens_when_the_minute_changes(monkeypatch):
+    now = [1000]
+    monkeypatch.setattr(tokens, "current_unix_minute", lambda: now[0])
+    store = TokenStore(ttl_minutes=60)
+    store.add("bob:1000")
+    now[0] = 1061
+    store.add("alice:1061")
+    assert len(store) == 1
+    assert store.lookup("alice:1061") == "alice"
+
+
+def test_least_recently_used_token_is_evicted(monkeypatch):
+    monkeypatch.setattr(tokens, "current_unix_minute", lambda: 1000)
+    store = TokenStore(ttl_minutes=60, max_size=2, static_tokens=["static:1"])
+    store.add("a:1000")
+    store.add("b:1000")
+    assert store.lookup("a:1000") == "a"
+    store.add("c:1000")
+    assert store.lookup("b:1000") is None
+    assert store.lookup("a:1000") == "a"
+    assert store.lookup("c:1000") == "c"
+    # Static tokens neither expire nor count against max_size.
+    assert store.lookup("static:1") == "static"
+
+
+def test_malformed_tokens_are_not_stored():
+    store = TokenStore()
+    assert store.add("no-minute") is None
+    assert store.add("bob:notanumber") is None
+    assert len(store) == 0
+
+
+class FakeBackend:
+    def __init__(self):
+        self.tokens = {}
+        self.lookups = 0
+
+    def add(self, token, username, unix_minute):
+        self.tokens[token] = (username, unix_minute)
+
+    def lookup(self, token):
+        self.lookups += 1
+        return self.tokens.get(token)
+
+
+def test_cached_store_remembers_misses_until_the_token_is_added(monkeypatch):
+    monkeypatch.setattr(tokens, "current_unix_minute", lambda: 1000)
+    backend = FakeBackend()
+    store = CachedTokenStore(backend, ttl_minutes=60, cache_ttl=60, negative_cache_ttl=60)
+    assert store.lookup("bob:1000") is None
+    assert store.lookup("bob:1000") is None
+    assert backend.lookups == 1
+    store.add("bob:1000")
+    assert store.lookup("bob:1000") == "bob"
+    assert backend.lookups == 1
+
+
+def test_cached_store_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(tokens, "current_unix_minute", lambda: 1000)
+    backend = FakeBackend()
+    store = CachedTokenStore(backend, ttl_minutes=60, cache_ttl=60, max_size=2)
+    for token in ("a:1000", "b:1000", "c:1000"):
+        store.add(token)
+    assert store.lookup("c:1000") == "c"
+    assert backend.lookups == 0
+    # a fell out of the local cache and comes from the backend again.
+    assert store.lookup("a:1000") == "a"
+    assert backend.lookups == 1
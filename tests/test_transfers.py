@@ -0,0 +1,66 @@
+import threading
+import time
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event, func, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from src import aggregates, models
+from src.database import engine_options
+from src.main import create_app
+from src.transfers import TRANSFER_BATCH_MAX_SIZE, execute_transfer, execute_transfer_batch
+
+IBANS = ["ATA", "ATB", "ATC", "ATD"]
+
+
+def test_batch_and_single_transfers_conserve_money(tmp_path):
+    # A batch reads the balances, works out the new ones and writes them back.
+    # A single transfer from one of its accounts to another account must not
+    # slip in between, or its debit is overwritten and money appears.
+    url = f"sqlite:///{tmp_path}/transfers.db"
+    engine = create_engine(url, **engine_options(url))
+    models.Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def widen_race(conn, cursor, statement, parameters, context, executemany):
+        # Gives single transfers a chance to commit between the batch's
+        # balance read and its write.
+        if statement.startswith("SELECT accounts.iban"):
+            time.sleep(0.005)
+
+    with Session() as db:
+        db.add_all(models.Account(iban=iban, kontostand=10000) for iban in IBANS)
+        aggregates.record(db, [(None, 10000)] * len(IBANS))
+        db.commit()
+    errors = []
+
+    def run(worker):
+        for step in range(40):
+            try:
+                with Session() as db:
+                    if (worker + step) % 2:
+                        execute_transfer_batch(db, [("ATA", "ATB", 7), ("ATB", "ATC", 3), ("ATC", "ATA", 1)])
+                    else:
+                        execute_transfer(db, "ATB", "ATD", 5)
+            except OperationalError as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with Session() as db:
+        total = db.execute(select(func.sum(models.Account.kontostand))).scalar()
+        ledger = db.execute(select(func.count()).select_from(models.Transaction)).scalar()
+    assert total == 10000 * len(IBANS)
+    assert aggregates.reconcile(engine) is False
+    assert ledger > 0
+    assert len(errors) < 8 * 40
+
+
+def test_batch_size_is_capped():
+    transfer = {"from": "ATBOB001", "to": "ATALICE002", "amount": 1}
+    with TestClient(create_app()) as client:
+        response = client.post("/transfer/batch", json={"transfers": [transfer] * (TRANSFER_BATCH_MAX_SIZE + 1)}, headers={"Authorization": "Bearer alice:1760356500"})
+    assert response.status_code == 422